@@ -0,0 +1,309 @@
+import argparse
+import json
+import sys
+from functools import lru_cache
+from urllib.parse import urlsplit
+
+# Finds ECST violations in exported traces: synchronous calls a service makes
+# to another service while answering a request, although the data should be
+# served from the replica it keeps up to date through events.
+#
+#   python analyzer.py traces.json [more.json ...] [--json report.json]
+#
+# Reads Jaeger exports ({"data": [trace, ...]}, as served by the Jaeger API
+# and downloaded by its UI) and OTLP JSON ({"resourceSpans": [...]}, as
+# written by the OpenTelemetry file exporter), one document per file or one
+# per line. Files are streamed trace by trace and only aggregates are kept,
+# so the memory used does not depend on the size of the export.
+
+# Services keeping a replica of the data of other services
+DEFAULT_REPLICAS = {
+    "search": ("apartments", "reserve"),
+    "reserve": ("apartments",),
+}
+
+CHUNK_SIZE = 1024 * 1024
+EXAMPLES = 3
+
+decoder = json.JSONDecoder()
+
+
+class JsonStream:
+    # Reads JSON values from a file one at a time, pulling in chunks as needed
+    # and dropping what was already decoded
+
+    def __init__(self, file):
+        self.file = file
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        chunk = self.file.read(CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def peek(self):
+        # Next character that is not whitespace, None at the end of the file
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in " \t\r\n":
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.fill():
+                return None
+
+    def expect(self, character):
+        if self.peek() != character:
+            raise ValueError(f"Expected {character!r} at character {self.position} of the current chunk.")
+        self.position += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                # Incomplete value, unless the file ended
+                if not self.fill():
+                    raise
+                continue
+            # A number may continue in the next chunk
+            if end == len(self.buffer) and not self.eof and self.fill():
+                continue
+            self.position = end
+            return value
+
+    def items(self):
+        # Values of the array starting at the current position
+        self.expect("[")
+        if self.peek() == "]":
+            self.position += 1
+            return
+        while True:
+            yield self.value()
+            separator = self.peek()
+            self.position += 1
+            if separator == "]":
+                return
+            if separator != ",":
+                raise ValueError(f"Expected ',' or ']' but found {separator!r}.")
+
+    def members(self, streamed):
+        # (key, value) pairs of the object starting at the current position,
+        # the values of the streamed keys are iterators over their items
+        self.expect("{")
+        if self.peek() == "}":
+            self.position += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            if key in streamed and self.peek() == "[":
+                items = self.items()
+                yield key, items
+                for _ in items:
+                    pass
+            else:
+                yield key, self.value()
+            separator = self.peek()
+            self.position += 1
+            if separator == "}":
+                return
+            if separator != ",":
+                raise ValueError(f"Expected ',' or '}}' but found {separator!r}.")
+
+
+def read_spans(file):
+    # Yields (trace id, service, kind, has parent, url, duration in
+    # microseconds) for every span of every document in the file
+    stream = JsonStream(file)
+    while stream.peek() is not None:
+        for key, value in stream.members(("data", "resourceSpans")):
+            if key == "data":
+                for trace in value:
+                    yield from jaeger_spans(trace)
+            elif key == "resourceSpans":
+                for resource_spans in value:
+                    yield from otlp_spans(resource_spans)
+
+
+def jaeger_spans(trace):
+    processes = trace.get("processes") or {}
+    for span in trace.get("spans") or []:
+        process = span.get("process") or processes.get(span.get("processID")) or {}
+        tags = {tag["key"]: tag.get("value") for tag in span.get("tags") or []}
+        kind = tags.get("span.kind")
+        has_parent = kind == "client" and (bool(span.get("parentSpanID")) or any(reference.get("refType") == "CHILD_OF" for reference in span.get("references") or []))
+        yield (
+            span.get("traceID"),
+            process.get("serviceName"),
+            kind,
+            has_parent,
+            tags.get("http.url") or tags.get("url.full"),
+            span.get("duration") or 0,
+        )
+
+
+OTLP_KINDS = {2: "server", 3: "client", 4: "producer", 5: "consumer"}
+
+
+def otlp_spans(resource_spans):
+    resource = attributes((resource_spans.get("resource") or {}).get("attributes"))
+    service = resource.get("service.name")
+    # Older exports call the scopes instrumentation library
+    for scope_spans in resource_spans.get("scopeSpans") or resource_spans.get("instrumentationLibrarySpans") or []:
+        for span in scope_spans.get("spans") or []:
+            tags = attributes(span.get("attributes"))
+            kind = span.get("kind")
+            if isinstance(kind, str):
+                kind = kind.replace("SPAN_KIND_", "").lower()
+            else:
+                kind = OTLP_KINDS.get(kind)
+            duration = (int(span.get("endTimeUnixNano") or 0) - int(span.get("startTimeUnixNano") or 0)) // 1000
+            yield (
+                span.get("traceId"),
+                service,
+                kind,
+                bool(span.get("parentSpanId")),
+                tags.get("http.url") or tags.get("url.full"),
+                duration,
+            )
+
+
+def attributes(values):
+    # OTLP wraps every value in an object naming its type
+    result = {}
+    for attribute in values or []:
+        value = attribute.get("value") or {}
+        for wrapped in value.values():
+            result[attribute["key"]] = wrapped
+            break
+    return result
+
+
+@lru_cache(maxsize=4096)
+def host_and_path(url):
+    parts = urlsplit(url)
+    return parts.hostname, parts.path or "/"
+
+
+class CallGraph:
+
+    def __init__(self, replicas, aliases=None):
+        self.replicas = {service: set(sources) for service, sources in replicas.items()}
+        self.aliases = aliases or {}
+        self.spans = 0
+        self.requests = {}
+        # (caller, callee, path) -> [calls, on request path, total us, max us, example traces]
+        self.edges = {}
+
+    def add(self, trace_id, service, kind, has_parent, url, duration):
+        self.spans += 1
+        if kind == "server":
+            self.requests[service] = self.requests.get(service, 0) + 1
+            return
+        if kind != "client" or not url:
+            return
+
+        host, path = host_and_path(url.partition("?")[0])
+        callee = self.aliases.get(host, host)
+        key = (service, callee, path)
+        edge = self.edges.get(key)
+        if edge is None:
+            edge = self.edges[key] = [0, 0, 0, 0, []]
+        edge[0] += 1
+        edge[2] += duration
+        edge[3] = max(edge[3], duration)
+
+        # Calls without a parent are made outside of a request, e.g. by the
+        # snapshot bootstrap at startup
+        if has_parent:
+            edge[1] += 1
+            if self.is_violation(service, callee) and len(edge[4]) < EXAMPLES and trace_id not in edge[4]:
+                edge[4].append(trace_id)
+
+    def is_violation(self, caller, callee):
+        return callee in self.replicas.get(caller, ())
+
+    def report(self):
+        edges = []
+        violations = []
+        for (caller, callee, path), (calls, on_request_path, total, maximum, examples) in sorted(self.edges.items()):
+            edge = {
+                "caller": caller,
+                "callee": callee,
+                "path": path,
+                "calls": calls,
+                "on_request_path": on_request_path,
+                "mean_ms": round(total / calls / 1000, 3),
+                "max_ms": round(maximum / 1000, 3),
+            }
+            edges.append(edge)
+            if on_request_path and self.is_violation(caller, callee):
+                violations.append(dict(edge, example_traces=examples))
+        return {"spans": self.spans, "requests": self.requests, "edges": edges, "violations": violations}
+
+
+def print_report(report):
+    print(f"Analyzed {report['spans']} spans.")
+    print("")
+    print("Call graph (calls on request paths / all calls, mean and max duration):")
+    for edge in report["edges"]:
+        print(f"  {edge['caller']} -> {edge['callee']} {edge['path']}  {edge['on_request_path']}/{edge['calls']}  {edge['mean_ms']} ms  {edge['max_ms']} ms")
+    print("")
+    if not report["violations"]:
+        print("No ECST violations found.")
+        return
+    print(f"{len(report['violations'])} ECST violations, synchronous calls on request paths that the caller's replica should answer:")
+    for violation in report["violations"]:
+        print(f"  {violation['caller']} -> {violation['callee']} {violation['path']}  {violation['on_request_path']} calls, e.g. in traces {', '.join(violation['example_traces'])}")
+
+
+def parse_pairs(values, separator):
+    pairs = {}
+    for value in values or []:
+        key, _, target = value.partition(separator)
+        pairs.setdefault(key, []).append(target)
+    return pairs
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Detect ECST violations in exported Jaeger or OTLP JSON traces.")
+    parser.add_argument("files", nargs="+", help="trace exports, - reads standard input")
+    parser.add_argument("--replica", action="append", metavar="SERVICE:SOURCE", help=f"SERVICE keeps a replica of the data of SOURCE, replaces the defaults ({', '.join(f'{service}:{source}' for service, sources in DEFAULT_REPLICAS.items() for source in sources)})")
+    parser.add_argument("--alias", action="append", metavar="HOST=SERVICE", help="service answering at a host that is not named after it")
+    parser.add_argument("--json", metavar="FILE", help="also write the report as JSON")
+    args = parser.parse_args(arguments)
+
+    replicas = parse_pairs(args.replica, ":") if args.replica else DEFAULT_REPLICAS
+    aliases = {host: services[-1] for host, services in parse_pairs(args.alias, "=").items()}
+    graph = CallGraph(replicas, aliases)
+
+    for name in args.files:
+        file = sys.stdin if name == "-" else open(name, encoding="utf-8")
+        try:
+            for span in read_spans(file):
+                graph.add(*span)
+        finally:
+            if file is not sys.stdin:
+                file.close()
+
+    report = graph.report()
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
+
+    # Usable as a check, fails if there are violations
+    return 1 if report["violations"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
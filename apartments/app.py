@@ -1,26 +1,31 @@
-import sqlite3
 import uuid
 from flask import request
 from flask import Flask
 from flask import Response
+from flask import stream_with_context
 import logging
-import pika
 import json
 import time
 import os
-from opentelemetry import trace
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
-from opentelemetry.instrumentation.requests import RequestsInstrumentor
-from opentelemetry.instrumentation.flask import FlaskInstrumentor
+from common.db import ConnectionPool
+from common.publisher import EventPublisher
+from common.outbox import setup_outbox, add_to_outbox, stream_outbox, OutboxRelay
+from common.events import setup_sequence, next_sequence, next_sequences
+from common.migrations import migrate, rebuild_table
+from common.batch import read_items, batch_status, item_value
+from common.snapshot import stream_snapshot
+from common.serving import configure_logging
+from common.tracing import setup_tracing, shutdown_tracing
+from common.metrics import instrument_app, render_metrics
 
 app = Flask(__name__)
+db_pool = ConnectionPool("/home/data/apartments.db")
+# The relay marks events as sent once the broker confirmed them
+publisher = EventPublisher(exchanges=("apartments",), confirms=True)
+relay = OutboxRelay(db_pool, publisher)
 
-trace.set_tracer_provider(TracerProvider())
-trace.get_tracer_provider().add_span_processor(BatchSpanProcessor(OTLPSpanExporter())) 
-FlaskInstrumentor().instrument_app(app)
-RequestsInstrumentor().instrument()
+setup_tracing(app)
+instrument_app(app)
 
 
 @app.route("/add")
@@ -36,30 +41,28 @@ def add():
         return Response('{"result": false, "error": 2, "description": "Size is not a number."}', status=400, mimetype="application/json")
 
     # Connect and setup the database
-    db_connection = sqlite3.connect("/home/data/apartments.db", isolation_level=None)
-    cursor = db_connection.cursor()
-    cursor.execute("CREATE TABLE IF NOT EXISTS apartments (id text, name text, size integer)")
-
-    # Check if appartement already exists
-    cursor.execute("SELECT COUNT(id) FROM apartments WHERE name = ?", (name,))
-    already_exists = cursor.fetchone()[0]
-    if already_exists > 0:
-        return Response('{"result": false, "error": 2, "description": "Cannot proceed because this apartment already exists"}', status=400, mimetype="application/json")
-
-    # Add appartement
-    cursor.execute("INSERT INTO apartments (id, name, size) VALUES (?, ?, ?)", (str(id), name, int(size)))
-    cursor.close()
-    db_connection.close()
-
-    # Notify everybody that the apartment was added
-    mq_connection = pika.BlockingConnection(pika.ConnectionParameters("rabbitmq"))
-    channel = mq_connection.channel()
-    channel.exchange_declare(exchange="apartments", exchange_type="direct")
-    data_to_send = {"id": str(id), "name": name}
-    channel.basic_publish(exchange="apartments", routing_key="added", body=json.dumps(data_to_send))
-    mq_connection.close()
-
-    return Response('{"result": true, "description": "Apartment was added successfully."}', status=201, mimetype="application/json")
+    with db_pool.connection() as db_connection:
+        cursor = db_connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+
+        # Check if appartement already exists
+        cursor.execute("SELECT COUNT(id) FROM apartments WHERE name = ?", (name,))
+        already_exists = cursor.fetchone()[0]
+        if already_exists > 0:
+            return Response('{"result": false, "error": 2, "description": "Cannot proceed because this apartment already exists"}', status=400, mimetype="application/json")
+
+        # Add appartement
+        cursor.execute("INSERT INTO apartments (id, name, size) VALUES (?, ?, ?)", (str(id), name, int(size)))
+        sequence = next_sequence(cursor)
+
+        # Notify everybody that the apartment was added, once committed
+        data_to_send = {"id": str(id), "name": name, "size": int(size), "event_id": str(uuid.uuid4()), "version": sequence, "sequence": sequence, "timestamp": time.time()}
+        add_to_outbox(cursor, "apartments", "added", data_to_send)
+        cursor.execute("COMMIT")
+        cursor.close()
+    relay.wake()
+
+    return Response('{"result": true, "description": "Apartment was added successfully.", "sequence": ' + str(sequence) + '}', status=201, mimetype="application/json")
 
 @app.route("/delete")
 def delete():
@@ -69,30 +72,85 @@ def delete():
         return Response('{"result": false, "error": 1, "description": "Cannot proceed because you did not provide a name for the apartment."}', status=400, mimetype="application/json")
 
     # Connect and setup the database
-    db_connection = sqlite3.connect("/home/data/apartments.db", isolation_level=None)
-    cursor = db_connection.cursor()
-
-    # Check if appartement exists
-    cursor.execute("SELECT COUNT(id) FROM apartments WHERE name = ?", (name,))
-    already_exists = cursor.fetchone()[0]
-    if already_exists == 0:
-        return Response('{"result": false, "error": 2, "description": "Cannot proceed because this apartment does not exist"}', status=400, mimetype="application/json")
-
-    # Add appartement
-    cursor.execute("DELETE FROM apartments WHERE name = ?", (name, ))
-    cursor.close()
-    db_connection.close()
-
-    # Notify everybody that the apartment was added
-    mq_connection = pika.BlockingConnection(pika.ConnectionParameters("rabbitmq"))
-    channel = mq_connection.channel()
-    channel.exchange_declare(exchange="apartments", exchange_type="direct")
-    
-    data_to_send = {"name": name}
-    channel.basic_publish(exchange="apartments", routing_key="deleted", body=json.dumps(data_to_send))
-    mq_connection.close()
-
-    return Response('{"result": true, "description": "Apartment was deleted successfully."}', status=201, mimetype="application/json")
+    with db_pool.connection() as db_connection:
+        cursor = db_connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+
+        # Check if appartement exists
+        cursor.execute("SELECT COUNT(id) FROM apartments WHERE name = ?", (name,))
+        already_exists = cursor.fetchone()[0]
+        if already_exists == 0:
+            return Response('{"result": false, "error": 2, "description": "Cannot proceed because this apartment does not exist"}', status=400, mimetype="application/json")
+
+        # Add appartement
+        cursor.execute("DELETE FROM apartments WHERE name = ?", (name, ))
+        sequence = next_sequence(cursor)
+
+        # Notify everybody that the apartment was deleted, once committed
+        data_to_send = {"name": name, "event_id": str(uuid.uuid4()), "version": sequence, "sequence": sequence, "timestamp": time.time()}
+        add_to_outbox(cursor, "apartments", "deleted", data_to_send)
+        cursor.execute("COMMIT")
+        cursor.close()
+    relay.wake()
+
+    return Response('{"result": true, "description": "Apartment was deleted successfully.", "sequence": ' + str(sequence) + '}', status=201, mimetype="application/json")
+
+@app.route("/add_batch", methods=["POST"])
+def add_batch():
+    # Adds many apartments in one transaction, every item is validated on its
+    # own and gets its own result
+    try:
+        items = read_items(request.get_data())
+    except ValueError as e:
+        return Response(json.dumps({"result": False, "error": 1, "description": f"Cannot proceed because the body is not a JSON array or NDJSON of apartments. {e}"}), status=400, mimetype="application/json")
+
+    results = []
+    rows = []
+    with db_pool.connection() as db_connection:
+        cursor = db_connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+
+        # Check which apartments already exist, a chunk of names at a time
+        names = list(set(item_value(item, "name") for item in items) - {None})
+        taken = set()
+        for i in range(0, len(names), 500):
+            chunk = names[i:i + 500]
+            cursor.execute(f"SELECT name FROM apartments WHERE name IN ({','.join('?' * len(chunk))})", chunk)
+            taken.update(row[0] for row in cursor.fetchall())
+
+        for index, item in enumerate(items):
+            name = item_value(item, "name")
+            size = item_value(item, "size")
+
+            if name == None or size == None:
+                results.append({"index": index, "result": False, "error": 1, "description": "Cannot proceed because you did not provide a name and a size for the apartment."})
+                continue
+
+            if not size.isdigit():
+                results.append({"index": index, "result": False, "error": 2, "description": "Size is not a number."})
+                continue
+
+            if name in taken:
+                results.append({"index": index, "result": False, "error": 2, "description": "Cannot proceed because this apartment already exists"})
+                continue
+
+            taken.add(name)
+            rows.append((str(uuid.uuid4()), name, int(size)))
+            results.append({"index": index, "result": True, "description": "Apartment was added successfully."})
+
+        # Notify everybody about all added apartments, once committed
+        if rows:
+            cursor.executemany("INSERT INTO apartments (id, name, size) VALUES (?, ?, ?)", rows)
+            sequences = next_sequences(cursor, len(rows))
+            timestamp = time.time()
+            for (id, name, size), sequence, result in zip(rows, sequences, (result for result in results if result["result"])):
+                add_to_outbox(cursor, "apartments", "added", {"id": id, "name": name, "size": size, "event_id": str(uuid.uuid4()), "version": sequence, "sequence": sequence, "timestamp": timestamp})
+                result.update({"id": id, "sequence": sequence})
+        cursor.execute("COMMIT")
+        cursor.close()
+    relay.wake()
+
+    return Response(json.dumps({"result": len(rows) == len(items), "added": len(rows), "items": results}), status=batch_status(results), mimetype="application/json")
 
 @app.route("/")
 def hello():
@@ -101,28 +159,91 @@ def hello():
 
 @app.route("/apartments")
 def apartments():
-    if os.path.exists("/home/data/apartments.db"):
-        db_connection = sqlite3.connect("/home/data/apartments.db", isolation_level=None)
-        cursor = db_connection.cursor()
-        cursor.execute("SELECT id, name FROM apartments")
-        columns = [col[0] for col in cursor.description]
-        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    if os.path.exists(db_pool.path):
+        with db_pool.connection() as db_connection:
+            cursor = db_connection.cursor()
+            cursor.execute("SELECT id, name FROM apartments")
+            columns = [col[0] for col in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            cursor.close()
         return Response(json.dumps({"apartments": rows}), status=200, mimetype="application/json")
 
     return Response(json.dumps({"apartments": []}), status=200, mimetype="application/json")
 
 
+@app.route("/metrics")
+def metrics():
+    return Response(render_metrics(), status=200, content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route("/health")
+def health():
+    return Response('{"status": "ok"}', status=200, mimetype="application/json")
+
+
+@app.route("/snapshot")
+def snapshot():
+    return Response(stream_with_context(stream_snapshot(db_pool, "SELECT id, name, size FROM apartments")), status=200, mimetype="application/x-ndjson")
+
+
+@app.route("/events")
+def events():
+    # The events after the given sequence, for consumers whose queue missed them
+    after = request.args.get("after", "0")
+
+    if not after.isdigit():
+        return Response('{"result": false, "error": 1, "description": "Cannot proceed because after is not a sequence number."}', status=400, mimetype="application/json")
+
+    return Response(stream_with_context(stream_outbox(db_pool, int(after))), status=200, mimetype="application/x-ndjson")
+
+
+@app.route("/stats")
+def stats():
+    return Response(json.dumps({"db_pool": db_pool.stats(), "publisher": publisher.stats(), "outbox": relay.stats()}), status=200, mimetype="application/json")
+
+
+# Schema versions, applied in order at startup to new and existing files
+MIGRATIONS = [
+    ["CREATE TABLE IF NOT EXISTS apartments (id text, name text, size integer)"],
+    # Keys: the id is the primary key and names are unique
+    [
+        lambda db_connection: rebuild_table(db_connection, "apartments", "id text PRIMARY KEY, name text NOT NULL, size integer", "id, name, size", unique="name"),
+        "CREATE UNIQUE INDEX apartments_name ON apartments (name)",
+    ],
+]
+
+# Hot queries whose plans are compared when migrating
+QUERY_PLANS = {
+    "apartment_exists": ("SELECT COUNT(id) FROM apartments WHERE name = ?", (None,)),
+    "apartment_delete": ("DELETE FROM apartments WHERE name = ?", (None,)),
+}
+
+
+def setup_database():
+    with db_pool.connection() as db_connection:
+        migrate(db_connection, MIGRATIONS, QUERY_PLANS)
+        setup_sequence(db_connection)
+        setup_outbox(db_connection)
+
+
+def start_background_tasks():
+    setup_database()
+    relay.start()
+
+
+def stop_background_tasks():
+    relay.stop()
+    db_pool.close()
+    publisher.close()
+    shutdown_tracing()
+
+
 if __name__ == "__main__":
-    logging.basicConfig(format="%(message)s", level=1 * 10)
-    logging.getLogger("pika").setLevel(logging.WARNING)
-    logging.getLogger("sqlite3").setLevel(logging.WARNING)
-
-    # Setup db
-    db_connection = sqlite3.connect("/home/data/apartments.db", isolation_level=None)
-    cursor = db_connection.cursor()
-    cursor.execute("CREATE TABLE IF NOT EXISTS apartments (id text, name text, size integer)")
-    cursor.close()
-    db_connection.close()
-
-    logging.info("Start.")
-    app.run(host="0.0.0.0", threaded=True)
+    configure_logging()
+
+    start_background_tasks()
+    try:
+        logging.info("Start.")
+        app.run(host="0.0.0.0", threaded=True)
+    finally:
+        stop_background_tasks()
@@ -0,0 +1,25 @@
+import os
+from common.serving import configure_logging, elect_background_worker
+
+wsgi_app = "app:app"
+bind = "0.0.0.0:5000"
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_WORKERS", "2"))
+threads = int(os.environ.get("WEB_THREADS", "8"))
+graceful_timeout = int(os.environ.get("WEB_GRACEFUL_TIMEOUT", "30"))
+
+
+def post_worker_init(worker):
+    import app
+    configure_logging()
+
+    # The outbox relay has to run exactly once per container
+    if elect_background_worker("apartments"):
+        app.start_background_tasks()
+    else:
+        app.setup_database()
+
+
+def worker_exit(server, worker):
+    import app
+    app.stop_background_tasks()
@@ -0,0 +1,35 @@
+import json
+import os
+
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "10000"))
+
+
+def read_items(body):
+    # Items of a batch request, sent either as a JSON array or as one JSON
+    # object per line (NDJSON). Raises ValueError if the body is neither.
+    text = body.decode("utf-8").strip()
+    if text.startswith("["):
+        items = json.loads(text)
+    else:
+        items = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    if not items:
+        raise ValueError("The batch is empty.")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise ValueError(f"The batch holds {len(items)} items, at most {BATCH_MAX_ITEMS} are accepted per request.")
+    return items
+
+
+def batch_status(results):
+    # 201 if every item was written, 400 if none was and 207 otherwise
+    written = sum(1 for result in results if result["result"])
+    if written == len(results):
+        return 201
+    return 207 if written else 400
+
+
+def item_value(item, key):
+    # Values may be sent as numbers or as strings like the query parameters
+    if not isinstance(item, dict) or item.get(key) is None:
+        return None
+    return str(item[key])
@@ -0,0 +1,433 @@
+import base64
+import json
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import nullcontext
+from types import SimpleNamespace
+import pika
+import requests
+from flask import Response
+from opentelemetry import trace
+from opentelemetry.trace import SpanKind
+from common.encoding import decode_event
+from common.events import load_offsets, store_applied_offset, prune_versions
+from common.snapshot import SNAPSHOT_TIMEOUT
+from common.metrics import Gauge, HistogramFamily, SIZE_BUCKETS
+from common.tracing import extract_link
+
+CONSUMER_PREFETCH = int(os.environ.get("MQ_CONSUMER_PREFETCH", "256"))
+CONSUMER_BATCH_SIZE = int(os.environ.get("MQ_CONSUMER_BATCH_SIZE", "100"))
+CONSUMER_BATCH_WINDOW = float(os.environ.get("MQ_CONSUMER_BATCH_WINDOW", "0.05"))
+APPLIED_POLL_INTERVAL = 0.02
+APPLIED_MAX_WAIT = 30
+QUEUE_DEPTH_INTERVAL = 5
+CATCH_UP_INTERVAL = 0.5
+QUEUE_EXPIRES = float(os.environ.get("MQ_QUEUE_EXPIRES", "86400"))
+APPLY_RETRIES = 5
+APPLY_RETRY_INTERVAL = 0.1
+PRUNE_INTERVAL = 60
+
+apply_lag = HistogramFamily("mq_event_apply_lag_seconds", "Seconds from publishing an event until the transaction applying it was committed.", ("exchange",))
+batch_sizes = HistogramFamily("mq_consumer_batch_size", "Events applied in one transaction.", buckets=SIZE_BUCKETS)
+batch_duration = HistogramFamily("mq_consumer_batch_duration_seconds", "Seconds spent applying and committing a batch of events.")
+queue_depth = Gauge("mq_consumer_queue_depth", "Events waiting on the broker, as of the last check.", ("queue",))
+prefetched = Gauge("mq_consumer_prefetched", "Events delivered to the consumer but not yet applied.", ("queue",))
+
+tracer = trace.get_tracer(__name__)
+
+
+def declare_queue(mq_connection, queue_name, bindings):
+    # Declares the durable queue of a consumer, bound to the given (exchange,
+    # routing_key) pairs. The queue keeps the events published while the
+    # consumer is down and is deleted by the broker once it was not used for
+    # MQ_QUEUE_EXPIRES seconds. Returns the channel and whether the queue had
+    # to be created, it then misses the events published in the meantime.
+    try:
+        probe = mq_connection.channel()
+        probe.queue_declare(queue=queue_name, passive=True)
+        probe.close()
+        created = False
+    except pika.exceptions.ChannelClosedByBroker:
+        created = True
+
+    channel = mq_connection.channel()
+    for exchange in dict.fromkeys(exchange for exchange, _ in bindings):
+        channel.exchange_declare(exchange=exchange, exchange_type="direct", durable=True)
+    channel.queue_declare(queue=queue_name, durable=True, arguments={"x-expires": int(QUEUE_EXPIRES * 1000)})
+    for exchange, routing_key in bindings:
+        channel.queue_bind(exchange=exchange, queue=queue_name, routing_key=routing_key)
+    return channel, created
+
+
+def replica_queue_name(db_pool, prefix):
+    # Queue of a replica that keeps its own read model. The name is generated
+    # once and stored with the read model, so it outlives the container (and
+    # its hostname) being recreated, while a new database gets a new queue.
+    with db_pool.connection() as db_connection:
+        db_connection.execute("BEGIN IMMEDIATE")
+        db_connection.execute("CREATE TABLE IF NOT EXISTS consumer_queue (name text)")
+        db_connection.execute("INSERT INTO consumer_queue (name) SELECT ? WHERE NOT EXISTS (SELECT 1 FROM consumer_queue)", (f"{prefix}-{uuid.uuid4().hex}",))
+        name = db_connection.execute("SELECT name FROM consumer_queue").fetchone()[0]
+        db_connection.execute("COMMIT")
+    return name
+
+
+def replay_events(db_pool, url, exchange, handler, lock=None, batch_size=CONSUMER_BATCH_SIZE):
+    # Applies the events of the exchange published after the last applied
+    # one, read from the outbox of the producer, the same way as the ones
+    # from the queue. Returns how many were replayed, or None if the outbox
+    # no longer holds all of them and the read model has to be loaded from a
+    # snapshot. Post-commit steps are not run, models kept in memory are
+    # loaded from the database afterwards.
+    _, after = read_offsets(db_pool).get(exchange, (0, 0))
+    with requests.get(url, params={"after": after}, stream=True, timeout=SNAPSHOT_TIMEOUT) as response:
+        response.raise_for_status()
+        lines = response.iter_lines()
+        if not json.loads(next(lines))["complete"]:
+            return None
+
+        count = 0
+        batch = []
+        for line in lines:
+            if not line:
+                continue
+            event = json.loads(line)
+            if event["exchange"] != exchange:
+                continue
+            method = SimpleNamespace(exchange=event["exchange"], routing_key=event["routing_key"])
+            properties = pika.BasicProperties(content_type=event["content_type"], headers=event["headers"])
+            batch.append((method, properties, base64.b64decode(event["body"]), time.time()))
+            if len(batch) >= batch_size:
+                with lock or nullcontext():
+                    run_with_retries(db_pool, handler, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            with lock or nullcontext():
+                run_with_retries(db_pool, handler, batch)
+            count += len(batch)
+
+    logging.info(f"Replayed {count} {exchange} events after event {after}.")
+    return count
+
+
+def consume_in_batches(channel, queue_name, db_pool, handler, lock=None, ready=None, stopping=None, caught_up=None, applied_exchange=None, batch_size=CONSUMER_BATCH_SIZE, window=CONSUMER_BATCH_WINDOW):
+    # Gathers events until either batch_size events arrived or window seconds
+    # passed since the first one, applies them in one transaction and acks
+    # them only once the transaction is committed.
+    #
+    # handler(db_connection, method, properties, data) applies one event and
+    # may return a callable that is run after the commit.
+    #
+    # Until the ready event is set (i.e. while the read model is bootstrapped)
+    # events are only gathered, the prefetch limit keeps the rest on the
+    # broker while the connection keeps answering heartbeats.
+    #
+    # Once the stopping event is set the gathered events are applied and the
+    # consumer is cancelled, the broker requeues whatever it had prefetched.
+    #
+    # The caught_up event is set once, after the bootstrap, the broker had no
+    # event left for the consumer and all delivered ones were applied.
+    #
+    # With an applied_exchange, every batch that changed the read model is
+    # announced there once its post-commit steps ran, for caches of answers
+    # computed from the read model.
+    #
+    # Every PRUNE_INTERVAL seconds the versions of long deleted entities are
+    # pruned, see prune_versions().
+    batch_size = max(1, batch_size)
+    channel.basic_qos(prefetch_count=max(CONSUMER_PREFETCH, batch_size))
+    if applied_exchange is not None:
+        channel.exchange_declare(exchange=applied_exchange, exchange_type="fanout", durable=True)
+
+    batch = []
+    deadline = 0
+    depth_checked = 0
+    catch_up_checked = 0
+    versions_pruned = time.monotonic()
+    for method, properties, body in channel.consume(queue_name, inactivity_timeout=max(window, 0.01)):
+        if stopping is not None and stopping.is_set():
+            break
+
+        if time.monotonic() - depth_checked >= QUEUE_DEPTH_INTERVAL:
+            update_queue_depth(channel, queue_name, len(batch))
+            depth_checked = time.monotonic()
+
+        if method is not None:
+            batch.append((method, properties, body, time.time()))
+            if len(batch) == 1:
+                deadline = time.monotonic() + window
+
+        if ready is not None and not ready.is_set():
+            continue
+
+        if batch and (len(batch) >= batch_size or time.monotonic() >= deadline):
+            apply_batch(channel, db_pool, handler, batch, lock, applied_exchange)
+            batch = []
+
+        if time.monotonic() - versions_pruned >= PRUNE_INTERVAL:
+            prune_deleted_versions(db_pool)
+            versions_pruned = time.monotonic()
+
+        if caught_up is not None and not caught_up.is_set() and not batch and time.monotonic() - catch_up_checked >= CATCH_UP_INTERVAL:
+            if channel.queue_declare(queue=queue_name, passive=True).method.message_count == 0 and channel.get_waiting_message_count() == 0:
+                caught_up.set()
+            catch_up_checked = time.monotonic()
+
+    if batch and (ready is None or ready.is_set()):
+        apply_batch(channel, db_pool, handler, batch, lock, applied_exchange)
+    channel.cancel()
+
+
+def prune_deleted_versions(db_pool):
+    with db_pool.connection() as db_connection:
+        try:
+            pruned = prune_versions(db_connection)
+        except sqlite3.OperationalError:
+            logging.warning("Could not prune the versions of deleted entities, retrying later...")
+            return
+    if pruned:
+        logging.info(f"Pruned the versions of {pruned} deleted entities.")
+
+
+def consume_with_reconnects(mq_connection, channel, queue_name, bindings, connect, consume, stopping, lost=None, recreated=None):
+    # Runs consume(channel) until the stopping event is set. Whenever the
+    # connection to the broker is lost, lost() is called and the queue is
+    # declared again on a new connection from connect(). If the queue had to
+    # be created anew in the meantime, recreated() catches up with the events
+    # it missed before consuming goes on.
+    while True:
+        try:
+            consume(channel)
+        except Exception as e:
+            logging.warning(f"Lost the message queue ({e!r}), reconnecting...")
+        finally:
+            close_connection(mq_connection)
+        if stopping.is_set():
+            return
+
+        if lost is not None:
+            lost()
+        while True:
+            mq_connection = connect()
+            try:
+                channel, created = declare_queue(mq_connection, queue_name, bindings)
+                break
+            except Exception as e:
+                logging.warning(f"Could not declare queue {queue_name} ({e!r}), reconnecting...")
+                close_connection(mq_connection)
+        if created and recreated is not None:
+            recreated()
+        logging.info(f"Consuming from queue {queue_name} again.")
+
+
+def close_connection(mq_connection):
+    # The connection may be gone already
+    try:
+        if mq_connection.is_open:
+            mq_connection.close()
+    except Exception:
+        pass
+
+
+def update_queue_depth(channel, queue_name, gathered):
+    # The broker counts the events it did not deliver yet, the rest waits in
+    # the consumer
+    result = channel.queue_declare(queue=queue_name, passive=True)
+    queue_depth.set(result.method.message_count, queue_name)
+    prefetched.set(channel.get_waiting_message_count() + gathered, queue_name)
+
+
+def apply_batch(channel, db_pool, handler, batch, lock=None, applied_exchange=None):
+    # Events that cannot be decoded or applied are dropped. Failures of the
+    # database (sqlite3.OperationalError, e.g. a lock held for too long) are
+    # not the fault of the events, they are retried and then requeued.
+    with lock or nullcontext():
+        started = time.perf_counter()
+        try:
+            callbacks = run_with_retries(db_pool, handler, batch)
+        except sqlite3.OperationalError:
+            logging.exception(f"Could not apply a batch of {len(batch)} events, requeueing them...")
+            channel.basic_nack(delivery_tag=batch[-1][0].delivery_tag, multiple=True, requeue=True)
+            return
+        except Exception:
+            logging.exception(f"Could not apply a batch of {len(batch)} events, applying them one by one...")
+        else:
+            batch_duration.labels().observe(time.perf_counter() - started)
+            batch_sizes.labels().observe(len(batch))
+            run_callbacks(callbacks)
+            channel.basic_ack(delivery_tag=batch[-1][0].delivery_tag, multiple=True)
+            announce_applied(channel, applied_exchange)
+            return
+
+        # Isolate the faulty events so that they do not hold back the others
+        applied = 0
+        for event in batch:
+            method = event[0]
+            try:
+                callbacks = run_with_retries(db_pool, handler, [event])
+            except sqlite3.OperationalError:
+                logging.exception(f"Could not apply event {method.exchange}/{method.routing_key}, requeueing it and the rest of the batch...")
+                channel.basic_nack(delivery_tag=batch[-1][0].delivery_tag, multiple=True, requeue=True)
+                break
+            except Exception:
+                logging.exception(f"Dropping event {method.exchange}/{method.routing_key} that cannot be applied.")
+                channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            else:
+                run_callbacks(callbacks)
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+                applied += 1
+        if applied:
+            announce_applied(channel, applied_exchange)
+
+
+def announce_applied(channel, applied_exchange):
+    # The notification carries no data, it only tells that answers computed
+    # from the read model before may be stale now
+    if applied_exchange is not None:
+        channel.basic_publish(exchange=applied_exchange, routing_key="", body=b"")
+
+
+def run_with_retries(db_pool, handler, batch):
+    # Retries run_in_transaction with a growing pause while the database
+    # fails, the last failure is raised
+    for attempt in range(APPLY_RETRIES):
+        try:
+            return run_in_transaction(db_pool, handler, batch)
+        except sqlite3.OperationalError as e:
+            if attempt == APPLY_RETRIES - 1:
+                raise
+            logging.warning(f"Could not apply {len(batch)} events ({e}), retrying...")
+            time.sleep(APPLY_RETRY_INTERVAL * 2 ** attempt)
+
+
+def run_in_transaction(db_pool, handler, batch):
+    # Every event gets a consumer span linked to the span that published it,
+    # within a span covering the transaction of the whole batch
+    callbacks = []
+    links = [link for link in (extract_link(properties) for _, properties, _, _ in batch) if link is not None]
+    with tracer.start_as_current_span("apply events", kind=SpanKind.CONSUMER, links=links, attributes={"messaging.system": "rabbitmq", "messaging.batch.message_count": len(batch)}) as batch_span, db_pool.connection() as db_connection:
+        db_connection.execute("BEGIN IMMEDIATE")
+        try:
+            offsets = load_offsets(db_connection)
+            applied = {}
+            produced = []
+            for method, properties, body, received in batch:
+                data = decode_event(body, properties)
+
+                # Skip the events that were already part of the snapshot
+                sequence = data.get("sequence")
+                if sequence is not None:
+                    snapshot, _ = offsets.get(method.exchange, (0, 0))
+                    if sequence <= snapshot:
+                        continue
+                    applied[method.exchange] = max(sequence, applied.get(method.exchange, 0))
+                if "timestamp" in data:
+                    produced.append((method.exchange, data["timestamp"]))
+
+                link = extract_link(properties)
+                with tracer.start_as_current_span(f"{method.exchange} process", kind=SpanKind.CONSUMER, links=[link] if link is not None else None) as span:
+                    started = time.time()
+                    callback = handler(db_connection, method, properties, data)
+                    if span.is_recording():
+                        span.set_attributes(event_attributes(method, data, received, started))
+                if callback is not None:
+                    callbacks.append(callback)
+
+            for exchange, sequence in applied.items():
+                store_applied_offset(db_connection, exchange, sequence)
+            commit_started = time.time()
+            db_connection.execute("COMMIT")
+            batch_span.set_attribute("db.commit_ms", (time.time() - commit_started) * 1000)
+        except Exception:
+            db_connection.execute("ROLLBACK")
+            raise
+
+    committed = time.time()
+    for exchange, timestamp in produced:
+        apply_lag.labels(exchange).observe(max(committed - timestamp, 0))
+    return callbacks
+
+
+def event_attributes(method, data, received, started):
+    # Where the time between publishing and applying an event went
+    attributes = {
+        "messaging.system": "rabbitmq",
+        "messaging.destination.name": method.exchange,
+        "messaging.rabbitmq.destination.routing_key": method.routing_key,
+        "messaging.batch_wait_ms": (started - received) * 1000,
+        "db.apply_ms": (time.time() - started) * 1000,
+    }
+    if "event_id" in data:
+        attributes["messaging.message.id"] = data["event_id"]
+    if "sequence" in data:
+        attributes["messaging.event.sequence"] = data["sequence"]
+    if "timestamp" in data:
+        attributes["messaging.queue_wait_ms"] = max(received - data["timestamp"], 0) * 1000
+    return attributes
+
+
+def run_callbacks(callbacks):
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception:
+            logging.exception("Could not run the post-commit step of an event.")
+
+
+def wait_until_applied(db_pool, exchange, sequence, timeout, lock=None):
+    # Offsets of the read model once the event with the given sequence of
+    # the exchange is applied or the timeout passed. Any worker can answer
+    # this, the offsets are read from the database the consumer writes.
+    #
+    # The offsets are committed before the post-commit steps ran, with the
+    # lock the consumer holds across both they are only read once these are
+    # done as well.
+    deadline = time.monotonic() + timeout
+    while True:
+        with lock or nullcontext():
+            offsets = read_offsets(db_pool)
+        _, applied = offsets.get(exchange, (0, 0))
+        if sequence is None or applied >= sequence or time.monotonic() >= deadline:
+            return offsets
+        time.sleep(APPLIED_POLL_INTERVAL)
+
+
+def applied_response(db_pool, args, lock=None):
+    # Answer of the /applied route of a read model: up to which event of each
+    # exchange it is applied. Given a sequence, waits until the exchange got
+    # that far (or timeout seconds).
+    exchange = args.get("exchange")
+    sequence = args.get("sequence")
+    timeout = args.get("timeout", "10")
+
+    if sequence is not None and exchange is None:
+        return Response('{"result": false, "error": 1, "description": "Cannot proceed because you did not provide the exchange of the sequence."}', status=400, mimetype="application/json")
+
+    if (sequence is not None and not sequence.isdigit()) or not timeout.isdigit():
+        return Response('{"result": false, "error": 2, "description": "Sequence and timeout have to be numbers."}', status=400, mimetype="application/json")
+
+    sequence = int(sequence) if sequence is not None else None
+    offsets = wait_until_applied(db_pool, exchange, sequence, min(int(timeout), APPLIED_MAX_WAIT), lock=lock)
+    data = {
+        "applied": {name: {"snapshot": snapshot, "applied": offset} for name, (snapshot, offset) in offsets.items()},
+        "lag": apply_lag.stats(),
+    }
+
+    if sequence is not None and offsets.get(exchange, (0, 0))[1] < sequence:
+        data.update({"result": False, "error": 3, "description": "The event was not applied in time."})
+        return Response(json.dumps(data), status=504, mimetype="application/json")
+
+    return Response(json.dumps(data), status=200, mimetype="application/json")
+
+
+def read_offsets(db_pool):
+    with db_pool.connection() as db_connection:
+        try:
+            return load_offsets(db_connection)
+        except sqlite3.OperationalError:
+            # The database is not set up yet
+            return {}
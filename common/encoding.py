@@ -0,0 +1,45 @@
+import json
+import os
+import msgpack
+import pika
+
+# Wire format of the events. The content type and schema version travel in
+# the AMQP properties, so consumers decode both formats and can be rolled
+# out before the producers switch. Events without a content type are JSON,
+# as published before the format was introduced.
+EVENT_FORMAT = os.environ.get("MQ_EVENT_FORMAT", "msgpack")
+SCHEMA_VERSION = 1
+
+# Events are persistent, the consumer queues are durable and keep them
+# across restarts of the broker
+DELIVERY_MODE = pika.DeliveryMode.Persistent
+
+CONTENT_TYPES = {
+    "json": "application/json",
+    "msgpack": "application/msgpack",
+}
+
+
+def encode_event(data, format=EVENT_FORMAT):
+    # (body, properties) of an event, ready to be published
+    if format == "msgpack":
+        body = msgpack.packb(data, use_bin_type=True)
+    elif format == "json":
+        body = json.dumps(data)
+    else:
+        raise ValueError(f"Unknown event format {format}, choose from {', '.join(CONTENT_TYPES)}.")
+    return body, pika.BasicProperties(content_type=CONTENT_TYPES[format], headers={"schema_version": SCHEMA_VERSION}, delivery_mode=DELIVERY_MODE)
+
+
+def decode_event(body, properties=None):
+    headers = getattr(properties, "headers", None) or {}
+    schema_version = headers.get("schema_version", 1)
+    if schema_version > SCHEMA_VERSION:
+        raise ValueError(f"Cannot decode events of schema version {schema_version}, the newest known is {SCHEMA_VERSION}.")
+
+    content_type = getattr(properties, "content_type", None)
+    if content_type == CONTENT_TYPES["msgpack"]:
+        return msgpack.unpackb(body, raw=False)
+    if content_type in (None, CONTENT_TYPES["json"]):
+        return json.loads(body)
+    raise ValueError(f"Cannot decode events of content type {content_type}.")
@@ -0,0 +1,87 @@
+import os
+import time
+
+VERSION_RETENTION = float(os.environ.get("VERSION_RETENTION", "172800"))
+
+# Every event published on an exchange carries a sequence number that grows
+# with each write of the producing service. Consumers remember up to which
+# sequence a snapshot covered, so that events already contained in it are
+# not applied a second time.
+#
+# Events also carry a unique event_id and the version of the entity they
+# are about (its sequence at the time of the write). Consumers keep the
+# latest version applied per entity and skip redelivered, replayed and
+# overtaken events, so that applying an event twice is harmless.
+
+
+def setup_sequence(db_connection):
+    # Every worker sets up the database, the transaction keeps two of them
+    # from adding the row at the same time
+    db_connection.execute("BEGIN IMMEDIATE")
+    db_connection.execute("CREATE TABLE IF NOT EXISTS event_sequence (value integer)")
+    db_connection.execute("INSERT INTO event_sequence (value) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM event_sequence)")
+    db_connection.execute("COMMIT")
+
+
+def next_sequence(db_connection):
+    # Has to run in the transaction of the write the event is about
+    db_connection.execute("UPDATE event_sequence SET value = value + 1")
+    return current_sequence(db_connection)
+
+
+def next_sequences(db_connection, count):
+    # Reserves count sequence numbers at once for a batch of writes
+    db_connection.execute("UPDATE event_sequence SET value = value + ?", (count,))
+    last = current_sequence(db_connection)
+    return range(last - count + 1, last + 1)
+
+
+def current_sequence(db_connection):
+    return db_connection.execute("SELECT value FROM event_sequence").fetchone()[0]
+
+
+def setup_offsets(db_connection):
+    db_connection.execute("CREATE TABLE IF NOT EXISTS event_offsets (exchange text PRIMARY KEY, snapshot integer, applied integer)")
+
+
+def load_offsets(db_connection):
+    return {exchange: (snapshot, applied) for exchange, snapshot, applied in db_connection.execute("SELECT exchange, snapshot, applied FROM event_offsets")}
+
+
+def store_snapshot_offset(db_connection, exchange, sequence):
+    db_connection.execute("INSERT OR REPLACE INTO event_offsets (exchange, snapshot, applied) VALUES (?, ?, ?)", (exchange, sequence, sequence))
+
+
+def store_applied_offset(db_connection, exchange, sequence):
+    db_connection.execute("INSERT INTO event_offsets (exchange, snapshot, applied) VALUES (?, 0, ?) ON CONFLICT (exchange) DO UPDATE SET applied = MAX(applied, excluded.applied)", (exchange, sequence))
+
+
+def setup_versions(db_connection):
+    # Deleted entities keep their row with the time they were deleted, a late
+    # event about them is stale too. Tables of older versions get the column,
+    # the transaction keeps two workers from adding it at the same time.
+    db_connection.execute("BEGIN IMMEDIATE")
+    db_connection.execute("CREATE TABLE IF NOT EXISTS entity_versions (exchange text, entity text, version integer, deleted real, PRIMARY KEY (exchange, entity)) WITHOUT ROWID")
+    if "deleted" not in [row[1] for row in db_connection.execute("PRAGMA table_info(entity_versions)")]:
+        db_connection.execute("ALTER TABLE entity_versions ADD COLUMN deleted real")
+    db_connection.execute("CREATE INDEX IF NOT EXISTS entity_versions_deleted ON entity_versions (deleted) WHERE deleted IS NOT NULL")
+    db_connection.execute("COMMIT")
+
+
+def claim_version(db_connection, exchange, entity, version, deleted=False):
+    # Records the version of the entity an event is about, False if the same
+    # or a newer version was applied before. Events without a version are
+    # always applied.
+    if version is None:
+        return True
+    cursor = db_connection.execute("INSERT INTO entity_versions (exchange, entity, version, deleted) VALUES (?, ?, ?, ?) ON CONFLICT (exchange, entity) DO UPDATE SET version = excluded.version, deleted = excluded.deleted WHERE excluded.version > entity_versions.version", (exchange, entity, version, time.time() if deleted else None))
+    return cursor.rowcount > 0
+
+
+def prune_versions(db_connection, retention=VERSION_RETENTION):
+    # Forgets the entities deleted more than retention seconds ago once the
+    # applied offset of their exchange covers the deletion. Replays only
+    # bring events after that offset, and the retention outlasts the events
+    # still waiting in a queue.
+    cursor = db_connection.execute("DELETE FROM entity_versions WHERE deleted < ? AND version <= (SELECT applied FROM event_offsets WHERE event_offsets.exchange = entity_versions.exchange)", (time.time() - retention,))
+    return cursor.rowcount
@@ -0,0 +1,192 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import g, request
+
+# Upper bounds in seconds, the last bucket catches everything above
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# Named metrics, served in the Prometheus text format by render_metrics().
+# The numbers are kept per process, with several workers every scrape is
+# answered by one of them.
+registry = []
+registry_lock = threading.Lock()
+
+
+def register(metric):
+    with registry_lock:
+        registry.append(metric)
+
+
+class Histogram:
+    # Counts observations into fixed buckets, so that recording stays cheap
+    # and the memory used does not grow with the number of observations
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+        self._last = None
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._count += 1
+            self._sum += value
+            self._max = max(self._max, value)
+            self._last = value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def cumulative(self):
+        # (upper bound, observations up to it) pairs ending with infinity
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        pairs = []
+        running = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            running += count
+            pairs.append((bound, running))
+        return pairs, total
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-quantile
+        pairs, _ = self.cumulative()
+        count = pairs[-1][1]
+        if count == 0:
+            return None
+        for bound, running in pairs:
+            if running >= q * count:
+                return bound if bound != float("inf") else self._max
+
+    def stats(self):
+        pairs, total = self.cumulative()
+        count = pairs[-1][1]
+        return {
+            "count": count,
+            "mean": total / count if count else None,
+            "max": self._max if count else None,
+            "last": self._last,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": {str(bound): running for bound, running in pairs[:-1]},
+        }
+
+
+class HistogramFamily:
+    # One histogram per combination of label values, created on first use
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+        register(self)
+
+    def labels(self, *values):
+        with self._lock:
+            histogram = self._histograms.get(values)
+            if histogram is None:
+                histogram = self._histograms[values] = Histogram(self.buckets)
+            return histogram
+
+    def items(self):
+        with self._lock:
+            return list(self._histograms.items())
+
+    def stats(self):
+        return {",".join(values): histogram.stats() for values, histogram in self.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for values, histogram in self.items():
+            pairs, total = histogram.cumulative()
+            for bound, running in pairs:
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames + ('le',), values + (le,))} {running}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, values)} {total!r}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, values)} {pairs[-1][1]}")
+        return lines
+
+
+class Gauge:
+    # Either set explicitly or, given a function returning {label values:
+    # value}, read whenever the metrics are rendered
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._values = {}
+        self._lock = threading.Lock()
+        register(self)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def render(self):
+        if self.function is not None:
+            values = self.function()
+        else:
+            with self._lock:
+                values = dict(self._values)
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for labels, value in values.items():
+            lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+def render_metrics():
+    with registry_lock:
+        metrics = list(registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Every service times the requests it serves
+request_duration = HistogramFamily("http_request_duration_seconds", "Seconds spent serving a request until its body was sent.", ("route", "method", "status"))
+query_duration = HistogramFamily("query_duration_seconds", "Seconds spent on the hot queries of the read and write models.", ("query",))
+
+
+def instrument_app(app):
+    # Times every request of a Flask app by route pattern, so that the
+    # number of series does not depend on the parameters. Streamed bodies
+    # are included, the time is taken once the response is closed.
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def stop_timer(response):
+        started = g.pop("metrics_started", None)
+        if started is not None:
+            histogram = request_duration.labels(request.url_rule.rule if request.url_rule else "unmatched", request.method, str(response.status_code))
+            response.call_on_close(lambda: histogram.observe(time.perf_counter() - started))
+        return response
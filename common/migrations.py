@@ -0,0 +1,73 @@
+import logging
+import sqlite3
+
+# Versioned schema migrations. A service lists its migrations in order, each
+# one a list of SQL statements or functions taking the connection. The
+# version a database file is at is kept in PRAGMA user_version, so existing
+# files are upgraded in place and every migration runs exactly once.
+
+
+def migrate(db_connection, migrations, query_plans=None):
+    # Runs the pending migrations in one transaction and returns the hot
+    # queries, {name: (query, parameters)}, whose plans changed as
+    # {name: (plan before, plan after)}. BEGIN IMMEDIATE makes processes
+    # starting at the same time wait for each other.
+    db_connection.execute("BEGIN IMMEDIATE")
+    try:
+        version = db_connection.execute("PRAGMA user_version").fetchone()[0]
+        if version >= len(migrations):
+            db_connection.execute("COMMIT")
+            return {}
+
+        before = explain_all(db_connection, query_plans or {})
+        for number, steps in enumerate(migrations[version:], start=version + 1):
+            logging.info(f"Migrating {database_name(db_connection)} to version {number}...")
+            for step in steps:
+                if callable(step):
+                    step(db_connection)
+                else:
+                    db_connection.execute(step)
+        db_connection.execute(f"PRAGMA user_version = {len(migrations)}")
+        after = explain_all(db_connection, query_plans or {})
+        db_connection.execute("COMMIT")
+    except Exception:
+        db_connection.execute("ROLLBACK")
+        raise
+
+    changed = {name: (before[name], after[name]) for name in after if before[name] != after[name]}
+    for name, (plan_before, plan_after) in changed.items():
+        logging.info(f"Query plan of {name} changed from [{plan_before}] to [{plan_after}].")
+    return changed
+
+
+def rebuild_table(db_connection, table, definition, columns, unique=None):
+    # SQLite cannot add keys to an existing table, so the rows are copied
+    # into a new one. Of the rows sharing a value of the unique column only
+    # the first one written is kept, rows violating the new keys are dropped.
+    db_connection.execute(f"CREATE TABLE {table}_migrated ({definition})")
+    condition = f" WHERE rowid IN (SELECT MIN(rowid) FROM {table} GROUP BY {unique})" if unique else ""
+    db_connection.execute(f"INSERT OR IGNORE INTO {table}_migrated ({columns}) SELECT {columns} FROM {table}{condition} ORDER BY rowid")
+
+    dropped = db_connection.execute(f"SELECT (SELECT COUNT(*) FROM {table}) - (SELECT COUNT(*) FROM {table}_migrated)").fetchone()[0]
+    if dropped > 0:
+        logging.warning(f"Dropped {dropped} rows of {table} that violate its new keys.")
+
+    db_connection.execute(f"DROP TABLE {table}")
+    db_connection.execute(f"ALTER TABLE {table}_migrated RENAME TO {table}")
+
+
+def explain_all(db_connection, query_plans):
+    return {name: explain(db_connection, query, parameters) for name, (query, parameters) in query_plans.items()}
+
+
+def explain(db_connection, query, parameters):
+    try:
+        rows = db_connection.execute("EXPLAIN QUERY PLAN " + query, parameters).fetchall()
+    except sqlite3.Error:
+        # The tables do not exist yet
+        return None
+    return "; ".join(row[-1] for row in rows)
+
+
+def database_name(db_connection):
+    return db_connection.execute("PRAGMA database_list").fetchone()[2] or "the database"
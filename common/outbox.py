@@ -0,0 +1,169 @@
+import base64
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import pika
+from common.encoding import encode_event, DELIVERY_MODE
+from common.events import current_sequence
+from common.metrics import Gauge, HistogramFamily, SIZE_BUCKETS
+from common.tracing import inject_trace_context
+
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", "500"))
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", "0.05"))
+OUTBOX_RETRY_INTERVAL = float(os.environ.get("OUTBOX_RETRY_INTERVAL", "1"))
+OUTBOX_RETENTION = float(os.environ.get("OUTBOX_RETENTION", "172800"))
+PRUNE_INTERVAL = 60
+
+relay_batch_sizes = HistogramFamily("outbox_relay_batch_size", "Events published by the outbox relay at once.", buckets=SIZE_BUCKETS)
+
+# Events are written to the outbox in the transaction of the change they are
+# about and published by a relay afterwards, so that a write neither waits
+# for the broker nor gets lost when publishing fails. Events are published
+# at least once and in the order of their sequence, the consumers skip the
+# ones they applied before.
+
+
+def setup_outbox(db_connection):
+    # Sent events are kept for OUTBOX_RETENTION seconds, the partial index
+    # lets the relay find the unsent ones without reading those
+    db_connection.execute("CREATE TABLE IF NOT EXISTS outbox (sequence integer PRIMARY KEY, exchange text, routing_key text, content_type text, headers text, body blob, created real, sent real)")
+    db_connection.execute("CREATE INDEX IF NOT EXISTS outbox_unsent ON outbox (sequence) WHERE sent IS NULL")
+
+
+def add_to_outbox(db_connection, exchange, routing_key, data):
+    # Has to run in the transaction of the write the event is about. The
+    # trace context of the write is stored with the event.
+    body, properties = encode_event(data)
+    properties = inject_trace_context(properties)
+    db_connection.execute("INSERT INTO outbox (sequence, exchange, routing_key, content_type, headers, body, created) VALUES (?, ?, ?, ?, ?, ?, ?)", (data["sequence"], exchange, routing_key, properties.content_type, json.dumps(properties.headers), body, time.time()))
+
+
+def stream_outbox(db_pool, after):
+    # NDJSON like the snapshots: a header line telling whether the outbox
+    # still holds every event after the given sequence, followed by one line
+    # per event if it does. Read in one read transaction, so pruning cannot
+    # get in between. Consumers replay these to catch up without a snapshot.
+    with db_pool.connection() as db_connection:
+        db_connection.execute("BEGIN")
+        offset = current_sequence(db_connection)
+        earliest = db_connection.execute("SELECT MIN(sequence) FROM outbox").fetchone()[0]
+        complete = after >= offset or (earliest != None and earliest <= after + 1)
+        yield json.dumps({"offset": offset, "complete": complete}) + "\n"
+
+        if complete:
+            cursor = db_connection.execute("SELECT sequence, exchange, routing_key, content_type, headers, body FROM outbox WHERE sequence > ? ORDER BY sequence", (after,))
+            while True:
+                rows = cursor.fetchmany(OUTBOX_BATCH_SIZE)
+                if not rows:
+                    break
+                yield "".join(json.dumps(outbox_entry(*row)) + "\n" for row in rows)
+            cursor.close()
+        db_connection.execute("COMMIT")
+
+
+def outbox_entry(sequence, exchange, routing_key, content_type, headers, body):
+    # JSON events are stored as text, msgpack ones as bytes
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return {"sequence": sequence, "exchange": exchange, "routing_key": routing_key, "content_type": content_type, "headers": json.loads(headers), "body": base64.b64encode(body).decode("ascii")}
+
+
+class OutboxRelay:
+    # Publishes the unsent events in batches from a background thread. It
+    # runs in one worker per container; wake() lets the writes of that
+    # worker through at once, the others are picked up by polling.
+
+    def __init__(self, db_pool, publisher, batch_size=OUTBOX_BATCH_SIZE, poll_interval=OUTBOX_POLL_INTERVAL, retention=OUTBOX_RETENTION):
+        self.db_pool = db_pool
+        self.publisher = publisher
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._sent = 0
+        self._failures = 0
+        self.pending = Gauge("outbox_pending", "Events written to the outbox but not yet published.", function=self.count_pending)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        # Publishes what is still pending before returning
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+
+    def wake(self):
+        self._wakeup.set()
+
+    def run(self):
+        pruned = 0
+        while True:
+            self._wakeup.clear()
+            try:
+                published = self.relay_batch()
+            except Exception:
+                logging.exception(f"Could not publish the outbox, retrying in {OUTBOX_RETRY_INTERVAL} seconds...")
+                with self._lock:
+                    self._failures += 1
+                if self._stopping.wait(OUTBOX_RETRY_INTERVAL):
+                    return
+                continue
+
+            if time.monotonic() - pruned >= PRUNE_INTERVAL:
+                self.prune()
+                pruned = time.monotonic()
+
+            # A full batch means that there is more to publish
+            if published < self.batch_size:
+                if self._stopping.is_set():
+                    return
+                self._wakeup.wait(self.poll_interval)
+
+    def relay_batch(self):
+        with self.db_pool.connection() as db_connection:
+            rows = db_connection.execute("SELECT sequence, exchange, routing_key, content_type, headers, body FROM outbox WHERE sent IS NULL ORDER BY sequence LIMIT ?", (self.batch_size,)).fetchall()
+        if not rows:
+            return 0
+
+        # Consecutive events of the same exchange are published together. The
+        # publisher waits for the broker to confirm them, only the confirmed
+        # groups are marked as sent, the rest is published again.
+        groups = []
+        for sequence, exchange, routing_key, content_type, headers, body in rows:
+            if not groups or groups[-1][0] != exchange:
+                groups.append([exchange, sequence, sequence, []])
+            groups[-1][2] = sequence
+            groups[-1][3].append((routing_key, body, pika.BasicProperties(content_type=content_type, headers=json.loads(headers), delivery_mode=DELIVERY_MODE)))
+        for exchange, first, last, messages in groups:
+            self.publisher.publish_many(exchange, messages)
+            with self.db_pool.connection() as db_connection:
+                db_connection.execute("UPDATE outbox SET sent = ? WHERE sequence BETWEEN ? AND ? AND sent IS NULL", (time.time(), first, last))
+        relay_batch_sizes.labels().observe(len(rows))
+        with self._lock:
+            self._sent += len(rows)
+        return len(rows)
+
+    def prune(self):
+        with self.db_pool.connection() as db_connection:
+            db_connection.execute("DELETE FROM outbox WHERE sent < ?", (time.time() - self.retention,))
+
+    def count_pending(self):
+        with self.db_pool.connection() as db_connection:
+            try:
+                return {(): db_connection.execute("SELECT COUNT(*) FROM outbox WHERE sent IS NULL").fetchone()[0]}
+            except sqlite3.OperationalError:
+                # The database is not set up yet
+                return {}
+
+    def stats(self):
+        with self._lock:
+            return {"sent": self._sent, "failures": self._failures, "running": self._thread is not None and self._thread.is_alive()}
@@ -0,0 +1,58 @@
+# Overlap checks on the reservations table of a service. Besides its period
+# every reservation keeps max_end, the latest end of the reservations of its
+# apartment starting before it, or its own end if that is later. max_end
+# grows along the index (apartment, period_from, max_end), so the latest end
+# of everything starting before a time is the entry just before it, a single
+# seek even if legacy reservations overlap. Writes keep it up to date with
+# update_max_ends(), loads of whole tables with update_all_max_ends().
+
+
+def latest_end(db_connection, apartment, before):
+    # Latest end of the reservations of the apartment starting before the
+    # given time, None if there are none. A period is free if it starts at or
+    # after the latest end of the reservations starting before it ends.
+    row = db_connection.execute("SELECT max_end FROM reservations WHERE apartment = ? AND period_from < ? ORDER BY period_from DESC, max_end DESC LIMIT 1", (apartment, before)).fetchone()
+    return row[0] if row != None else None
+
+
+def update_max_ends(db_connection, apartment, period_from):
+    # Has to run in the transaction that added, moved or deleted a reservation
+    # of the apartment starting at period_from. The reservations starting then
+    # and after are recomputed one start time at a time, until one of these
+    # groups was up to date already, the ones after it are as well. New
+    # reservations do not overlap, so this stops at the next one.
+    latest = latest_end(db_connection, apartment, period_from)
+    start = period_from
+    first = True
+    while start != None:
+        rows = db_connection.execute("SELECT id, period_to, max_end FROM reservations WHERE apartment = ? AND period_from = ?", (apartment, start)).fetchall()
+        changed = False
+        for id, period_to, max_end in rows:
+            expected = period_to if latest == None else max(period_to, latest)
+            if max_end != expected:
+                db_connection.execute("UPDATE reservations SET max_end = ? WHERE id = ?", (expected, id))
+                changed = True
+        if not changed and not first:
+            break
+
+        first = False
+        for _, period_to, _ in rows:
+            latest = period_to if latest == None else max(latest, period_to)
+        start = db_connection.execute("SELECT MIN(period_from) FROM reservations WHERE apartment = ? AND period_from > ?", (apartment, start)).fetchone()[0]
+
+
+def update_all_max_ends(db_connection):
+    # One pass over the whole table, after loading a snapshot or migrating
+    updates = []
+    apartment, start, latest, group_latest = None, None, None, None
+    for id, row_apartment, period_from, period_to, max_end in db_connection.execute("SELECT id, apartment, period_from, period_to, max_end FROM reservations ORDER BY apartment, period_from").fetchall():
+        if row_apartment != apartment:
+            apartment, start, latest, group_latest = row_apartment, period_from, None, None
+        elif period_from != start:
+            start = period_from
+            latest = group_latest
+        expected = period_to if latest == None else max(period_to, latest)
+        group_latest = period_to if group_latest == None else max(group_latest, period_to)
+        if max_end != expected:
+            updates.append((expected, id))
+    db_connection.executemany("UPDATE reservations SET max_end = ? WHERE id = ?", updates)
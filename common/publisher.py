@@ -0,0 +1,146 @@
+import logging
+import os
+import queue
+import threading
+import pika
+from opentelemetry import trace
+from opentelemetry.trace import SpanKind
+from common.metrics import HistogramFamily
+from common.tracing import extract_link, inject_trace_context
+
+MQ_HOST = os.environ.get("MQ_HOST", "rabbitmq")
+PUBLISHER_POOL_SIZE = int(os.environ.get("MQ_PUBLISHER_POOL_SIZE", "4"))
+
+tracer = trace.get_tracer(__name__)
+publish_duration = HistogramFamily("mq_publish_duration_seconds", "Seconds spent publishing events, including retries.", ("exchange",))
+
+
+class EventPublisher:
+    # Pool of long-lived connections/channels used to publish events.
+    # BlockingConnection is not thread safe, so every Flask thread borrows a
+    # whole connection for the duration of a publish. With confirms a publish
+    # only returns once the broker has taken the events.
+
+    def __init__(self, exchanges, host=MQ_HOST, size=PUBLISHER_POOL_SIZE, confirms=False):
+        self.exchanges = exchanges
+        self.host = host
+        self.confirms = confirms
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._connections = 0
+        self._published = 0
+        self._reconnects = 0
+        self._failures = 0
+
+    def _open(self):
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host))
+        channel = connection.channel()
+        if self.confirms:
+            channel.confirm_delivery()
+        for exchange in self.exchanges:
+            channel.exchange_declare(exchange=exchange, exchange_type="direct", durable=True)
+
+        with self._lock:
+            self._connections += 1
+        return connection, channel
+
+    def _discard(self, entry):
+        connection, _ = entry
+        with self._lock:
+            self._connections -= 1
+        try:
+            if connection.is_open:
+                connection.close()
+        except Exception:
+            pass
+
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    entry = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._open()
+
+                # Idle connections still have to answer the broker heartbeats
+                connection, channel = entry
+                try:
+                    if connection.is_open and channel.is_open:
+                        connection.process_data_events(time_limit=0)
+                        return entry
+                except Exception:
+                    pass
+                self._discard(entry)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, entry):
+        self._idle.put(entry)
+        self._slots.release()
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        self.publish_many(exchange, [(routing_key, body, properties)])
+
+    def publish_many(self, exchange, messages):
+        # The consumers link the spans applying the events to the span of
+        # the publish, or to the span of the write if the event carries its
+        # context already (published from the outbox)
+        attributes = {"messaging.system": "rabbitmq", "messaging.destination.name": exchange, "messaging.batch.message_count": len(messages)}
+        links = [link for link in (extract_link(properties) for _, _, properties in messages) if link is not None]
+        with tracer.start_as_current_span(f"{exchange} publish", kind=SpanKind.PRODUCER, attributes=attributes, links=links):
+            messages = [(routing_key, body, inject_trace_context(properties)) for routing_key, body, properties in messages]
+            with publish_duration.labels(exchange).time():
+                self._publish_many(exchange, messages)
+
+    def _publish_many(self, exchange, messages):
+        # A lost connection is reopened and the publish retried once. With
+        # confirms enabled basic_publish only returns once the broker has
+        # taken the message.
+        for attempt in range(2):
+            entry = self._acquire()
+            connection, channel = entry
+            try:
+                for routing_key, body, properties in messages:
+                    channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+            except pika.exceptions.AMQPError as e:
+                self._discard(entry)
+                self._slots.release()
+                with self._lock:
+                    self._reconnects += 1
+                if attempt == 1:
+                    with self._lock:
+                        self._failures += 1
+                    raise
+                logging.warning(f"Publishing to {exchange} failed ({e!r}), reconnecting...")
+                continue
+            except Exception:
+                self._discard(entry)
+                self._slots.release()
+                raise
+
+            self._release(entry)
+            with self._lock:
+                self._published += len(messages)
+            return
+
+    def close(self):
+        while True:
+            try:
+                entry = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(entry)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "connections": self._connections,
+                "idle": self._idle.qsize(),
+                "published": self._published,
+                "reconnects": self._reconnects,
+                "failures": self._failures,
+                "confirms": self.confirms,
+            }
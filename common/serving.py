@@ -0,0 +1,58 @@
+import fcntl
+import logging
+import os
+
+LOCK_DIR = os.environ.get("LOCK_DIR", "/tmp")
+
+# Keeps the lock files open (and therefore locked) for the life of the process
+_lock_files = {}
+
+
+def configure_logging():
+    logging.basicConfig(format="%(message)s", level=1 * 10)
+    logging.getLogger("pika").setLevel(logging.WARNING)
+    logging.getLogger("sqlite3").setLevel(logging.WARNING)
+
+
+def elect_background_worker(name):
+    # Background tasks such as the event consumer have to run in exactly one
+    # worker process per container. The first worker taking the lock wins, if
+    # it dies the lock is released and its replacement takes over.
+    lock_file = open(os.path.join(LOCK_DIR, f"{name}.lock"), "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+
+    _lock_files[name] = lock_file
+    logging.info(f"Process {os.getpid()} runs the background tasks of {name}.")
+    return True
+
+
+def mark_ready(name, ready):
+    # Readiness of the background tasks, shared with the other workers of
+    # the container through a file next to the election lock
+    path = os.path.join(LOCK_DIR, f"{name}.ready")
+    if ready:
+        open(path, "w").close()
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def is_ready(name):
+    return os.path.exists(os.path.join(LOCK_DIR, f"{name}.ready"))
+
+
+def mark_failed(name, failed):
+    # Background tasks that stopped for good, so that every worker of the
+    # container reports it at /health
+    path = os.path.join(LOCK_DIR, f"{name}.failed")
+    if failed:
+        open(path, "w").close()
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def has_failed(name):
+    return os.path.exists(os.path.join(LOCK_DIR, f"{name}.failed"))
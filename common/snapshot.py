@@ -0,0 +1,51 @@
+import json
+import os
+import requests
+from common.events import current_sequence, store_snapshot_offset
+
+SNAPSHOT_CHUNK_SIZE = int(os.environ.get("SNAPSHOT_CHUNK_SIZE", "1000"))
+SNAPSHOT_TIMEOUT = float(os.environ.get("SNAPSHOT_TIMEOUT", "30"))
+
+
+def stream_snapshot(db_pool, query):
+    # NDJSON: a header line with the sequence of the last event contained in
+    # the snapshot, followed by one line per row. Rows and offset are read
+    # in the same read transaction, so they are consistent with each other.
+    with db_pool.connection() as db_connection:
+        db_connection.execute("BEGIN")
+        yield json.dumps({"offset": current_sequence(db_connection)}) + "\n"
+
+        cursor = db_connection.execute(query)
+        columns = [col[0] for col in cursor.description]
+        while True:
+            rows = cursor.fetchmany(SNAPSHOT_CHUNK_SIZE)
+            if not rows:
+                break
+            yield "".join(json.dumps(dict(zip(columns, row))) + "\n" for row in rows)
+        cursor.close()
+        db_connection.execute("COMMIT")
+
+
+def load_snapshot(db_connection, url, exchange, insert, to_row):
+    # Has to run inside a transaction, the rows and the offset of the
+    # snapshot are stored together
+    with requests.get(url, stream=True, timeout=SNAPSHOT_TIMEOUT) as response:
+        response.raise_for_status()
+        lines = response.iter_lines()
+        offset = json.loads(next(lines))["offset"]
+
+        count = 0
+        chunk = []
+        for line in lines:
+            if not line:
+                continue
+            chunk.append(to_row(json.loads(line)))
+            if len(chunk) >= SNAPSHOT_CHUNK_SIZE:
+                db_connection.executemany(insert, chunk)
+                count += len(chunk)
+                chunk = []
+        db_connection.executemany(insert, chunk)
+        count += len(chunk)
+
+    store_snapshot_offset(db_connection, exchange, offset)
+    return count, offset
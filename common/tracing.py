@@ -0,0 +1,200 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+import pika
+from opentelemetry import propagate, trace
+from opentelemetry.sdk.trace import ReadableSpan, SpanProcessor, TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.sdk.trace.sampling import ALWAYS_ON, Decision, ParentBased, Sampler, SamplingResult, TraceIdRatioBased
+from opentelemetry.trace import Link, SpanContext, StatusCode, TraceFlags
+from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+from opentelemetry.instrumentation.requests import RequestsInstrumentor
+from opentelemetry.instrumentation.flask import FlaskInstrumentor
+
+# The batch processor reads its settings from the standard OTEL_BSP_*
+# variables (queue size, batch size, delay and export timeout)
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "1") == "1"
+TRACING_SAMPLER = os.environ.get("TRACING_SAMPLER", "always_on")
+TRACING_SAMPLE_RATIO = float(os.environ.get("TRACING_SAMPLE_RATIO", "0.1"))
+TRACING_RATE_LIMIT = float(os.environ.get("TRACING_RATE_LIMIT", "10"))
+TRACING_KEEP_ERRORS = os.environ.get("TRACING_KEEP_ERRORS", "0") == "1"
+TRACING_SLOW_THRESHOLD_MS = float(os.environ.get("TRACING_SLOW_THRESHOLD_MS", "0"))
+MAX_BUFFERED_TRACES = 10000
+
+tracer_provider = None
+
+
+class RateLimitedSampler(Sampler):
+    # Samples at most rate new traces per second, a token bucket lets short
+    # bursts of up to one second worth of traces through
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def should_sample(self, parent_context, trace_id, name, kind=None, attributes=None, links=None, trace_state=None):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            sampled = self._tokens >= 1
+            if sampled:
+                self._tokens -= 1
+        return SamplingResult(Decision.RECORD_AND_SAMPLE if sampled else Decision.DROP, attributes if sampled else None)
+
+    def get_description(self):
+        return f"RateLimitedSampler{{{self.rate}}}"
+
+
+class RecordingSampler(Sampler):
+    # Records the spans the wrapped sampler drops instead of discarding them,
+    # so that their trace can still be exported once it turns out to have
+    # failed or to be slow
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+
+    def should_sample(self, parent_context, trace_id, name, kind=None, attributes=None, links=None, trace_state=None):
+        result = self.sampler.should_sample(parent_context, trace_id, name, kind, attributes, links, trace_state)
+        if result.decision == Decision.DROP:
+            return SamplingResult(Decision.RECORD_ONLY, attributes, result.trace_state)
+        return result
+
+    def get_description(self):
+        return f"RecordingSampler{{{self.sampler.get_description()}}}"
+
+
+class KeepErrorsAndSlowTraces(SpanProcessor):
+    # Passes sampled spans on. The spans that were only recorded are buffered
+    # per trace until the local root of the trace (the first span of this
+    # service) ends, the whole local trace is passed on if the root was
+    # slower than the threshold or any of its spans failed. Services called
+    # within the trace decide on their own part of it the same way.
+    #
+    # Spans ending after their root and traces whose root never ends would
+    # stay buffered, the oldest traces are dropped beyond max_traces.
+
+    def __init__(self, processor, keep_errors, slow_threshold_ms, max_traces=MAX_BUFFERED_TRACES):
+        self.processor = processor
+        self.keep_errors = keep_errors
+        self.slow_threshold_ns = slow_threshold_ms * 1000000
+        self.max_traces = max_traces
+        self._traces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def on_start(self, span, parent_context=None):
+        self.processor.on_start(span, parent_context)
+
+    def on_end(self, span):
+        if span.context.trace_flags.sampled:
+            self.processor.on_end(span)
+            return
+
+        failed = self.keep_errors and span.status.status_code == StatusCode.ERROR
+        with self._lock:
+            spans, kept = self._traces.pop(span.context.trace_id, ([], False))
+            spans.append(span)
+            kept = kept or failed
+            if span.parent is not None and not span.parent.is_remote:
+                self._traces[span.context.trace_id] = (spans, kept)
+                while len(self._traces) > self.max_traces:
+                    self._traces.popitem(last=False)
+                return
+
+        slow = self.slow_threshold_ns > 0 and span.end_time - span.start_time >= self.slow_threshold_ns
+        if kept or slow:
+            for buffered in spans:
+                self.processor.on_end(sampled_copy(buffered))
+
+    def shutdown(self):
+        self.processor.shutdown()
+
+    def force_flush(self, timeout_millis=30000):
+        return self.processor.force_flush(timeout_millis)
+
+
+def sampled_copy(span):
+    context = span.context
+    return ReadableSpan(
+        name=span.name,
+        context=SpanContext(context.trace_id, context.span_id, context.is_remote, TraceFlags(TraceFlags.SAMPLED), context.trace_state),
+        parent=span.parent,
+        resource=span.resource,
+        attributes=span.attributes,
+        events=span.events,
+        links=span.links,
+        kind=span.kind,
+        status=span.status,
+        start_time=span.start_time,
+        end_time=span.end_time,
+        instrumentation_scope=span.instrumentation_scope,
+    )
+
+
+def create_sampler(sampler=TRACING_SAMPLER, ratio=TRACING_SAMPLE_RATIO, rate=TRACING_RATE_LIMIT, keep=TRACING_KEEP_ERRORS or TRACING_SLOW_THRESHOLD_MS > 0):
+    # The sampler only decides on new traces, the services called within a
+    # trace follow the decision of their caller
+    if sampler == "ratio":
+        root = TraceIdRatioBased(ratio)
+    elif sampler == "rate_limited":
+        root = RateLimitedSampler(rate)
+    elif sampler == "always_on":
+        root = ALWAYS_ON
+    else:
+        raise ValueError(f"Unknown sampler {sampler}, choose from always_on, ratio and rate_limited.")
+
+    parent_based = ParentBased(root)
+    return RecordingSampler(parent_based) if keep else parent_based
+
+
+def create_tracer_provider(exporter=None, sampler=None, keep_errors=TRACING_KEEP_ERRORS, slow_threshold_ms=TRACING_SLOW_THRESHOLD_MS):
+    provider = TracerProvider(sampler=sampler or create_sampler(keep=keep_errors or slow_threshold_ms > 0))
+    processor = BatchSpanProcessor(exporter or OTLPSpanExporter())
+    if keep_errors or slow_threshold_ms > 0:
+        processor = KeepErrorsAndSlowTraces(processor, keep_errors, slow_threshold_ms)
+    provider.add_span_processor(processor)
+    return provider
+
+
+def inject_trace_context(properties):
+    # Carries the W3C trace context of the current span to the consumers of
+    # an event in the AMQP headers. A context stored with the event before
+    # (by the outbox) is kept.
+    headers = {}
+    propagate.inject(headers)
+    if not headers:
+        return properties
+    if properties is None:
+        return pika.BasicProperties(headers=headers)
+    properties.headers = dict(headers, **(properties.headers or {}))
+    return properties
+
+
+def extract_link(properties):
+    # Link to the span that published an event, None if it was not traced
+    headers = getattr(properties, "headers", None)
+    if not headers:
+        return None
+    context = trace.get_current_span(propagate.extract(headers)).get_span_context()
+    return Link(context) if context.is_valid else None
+
+
+def setup_tracing(app):
+    # Traces the requests served by the app and the ones it sends
+    global tracer_provider
+    if not TRACING_ENABLED:
+        return
+
+    tracer_provider = create_tracer_provider()
+    trace.set_tracer_provider(tracer_provider)
+    FlaskInstrumentor().instrument_app(app)
+    RequestsInstrumentor().instrument()
+
+
+def shutdown_tracing():
+    # Exports the spans still queued
+    if tracer_provider is not None:
+        tracer_provider.shutdown()
@@ -2,9 +2,71 @@ from flask import Flask
 from flask import request
 from flask import Response
 import logging
+import os
+import json
 import requests
+from requests.adapters import HTTPAdapter
+from engine import CONNECT_TIMEOUT, READ_TIMEOUT, POOL_SIZE, CHUNK_SIZE, UPSTREAMS, cache, search_replicas, start_background_tasks, cached_answer
+from common.serving import configure_logging
+from common.metrics import instrument_app, render_metrics
 
 app = Flask(__name__)
+instrument_app(app)
+
+
+def create_session(hosts=1):
+    # One keep-alive connection pool per upstream service, and per replica
+    # for the replicated ones
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=hosts, pool_maxsize=POOL_SIZE))
+    return session
+
+
+sessions = {
+    "apartments": create_session(),
+    "reserve": create_session(),
+    "search": create_session(hosts=16),
+}
+
+
+def forward(upstream, url, replica=None):
+    cached, fill = cached_answer(request.path, request.args.items(multi=True))
+    if cached is not None:
+        status, content_type, body = cached
+        return Response(body, status, content_type=content_type)
+
+    logging.info(f"Requesting content from {url}...")
+    try:
+        if request.method == "POST":
+            # Bodies of batch writes are passed on as they are
+            response = sessions[upstream].post(url, data=request.get_data(), headers={"Content-Type": request.content_type or "application/json"}, stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        else:
+            response = sessions[upstream].get(url, stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    except requests.exceptions.Timeout:
+        return Response('{"result": false, "error": 3, "description": "The service did not answer in time."}', status=504, mimetype="application/json")
+    except requests.exceptions.ConnectionError:
+        if replica is not None:
+            search_replicas.failed(replica)
+        return Response('{"result": false, "error": 3, "description": "The service is not reachable."}', status=502, mimetype="application/json")
+
+    content_type = response.headers.get("Content-Type", "application/json")
+
+    # Pass the body through chunk by chunk instead of buffering it, small
+    # enough answers are collected on the way for the cache
+    def generate():
+        try:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if fill is not None:
+                    fill.add(chunk)
+                yield chunk
+        finally:
+            response.close()
+
+        if fill is not None:
+            fill.finish(response.status_code, content_type)
+
+    return Response(generate(), response.status_code, content_type=content_type)
+
 
 @app.route("/")
 def standard():
@@ -14,32 +76,82 @@ def standard():
 @app.route("/apartments/add")
 @app.route("/apartments/delete")
 @app.route("/apartments/apartments")
+@app.route("/apartments/add_batch", methods=["POST"])
 def apartments():
-    url = request.url.replace(request.host_url + "apartments", f"http://apartments:5000")
-    logging.info(f"Requesting content from {url}...")
-    response = requests.get(url)
-    return Response(response.content, response.status_code, mimetype="application/json")
+    url = request.url.replace(request.host_url + "apartments", UPSTREAMS["apartments"])
+    return forward("apartments", url)
 
 @app.route("/reserve/")
 @app.route("/reserve/add")
 @app.route("/reserve/delete")
 @app.route("/reserve/reservations")
+@app.route("/reserve/add_batch", methods=["POST"])
 def reserve():
-    url = request.url.replace(request.host_url + "reserve", f"http://reserve:5000")
-    logging.info(f"Requesting content from {url}...")
-    response = requests.get(url)
-    return Response(response.content, response.status_code, mimetype="application/json")
+    url = request.url.replace(request.host_url + "reserve", UPSTREAMS["reserve"])
+    return forward("reserve", url)
 
 
 @app.route("/search")
+@app.route("/search/flexible")
 def search():
-    url = request.url.replace(request.host_url, f"http://search:5000/")
-    logging.info(f"Requesting content from {url}...")
-    response = requests.get(url)
-    return Response(response.content, response.status_code, mimetype="application/json")
+    replica = search_replicas.choose()
+    if replica == None:
+        return Response('{"result": false, "error": 3, "description": "No search replica is ready."}', status=503, mimetype="application/json")
+    url = request.url.replace(request.host_url, replica + "/")
+    return forward("search", url, replica)
+
+
+@app.route("/metrics")
+def metrics():
+    return Response(render_metrics(), status=200, content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route("/health")
+def health():
+    return Response('{"status": "ok"}', status=200, mimetype="application/json")
+
+
+@app.route("/cache/stats")
+def cache_stats():
+    return Response(json.dumps(cache.stats()), status=200, mimetype="application/json")
+
+
+@app.route("/replicas/stats")
+def replicas_stats():
+    return Response(json.dumps({"search": search_replicas.stats()}), status=200, mimetype="application/json")
+
+
+@app.route("/replicas/applied")
+def replicas_applied():
+    # Asks every ready search replica whether it applied an event (/applied
+    # with the same parameters), so that the next search reflects the event
+    # whichever replica answers it. The first failure decides the status.
+    replicas = search_replicas.stats()["ready"]
+    if not replicas:
+        return Response('{"result": false, "error": 3, "description": "No search replica is ready."}', status=503, mimetype="application/json")
+
+    status = 200
+    applied = {}
+    for replica in replicas:
+        try:
+            response = sessions["search"].get(replica + "/applied", params=request.args, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            applied[replica] = response.json()
+            replica_status = response.status_code
+        except (requests.exceptions.RequestException, ValueError):
+            applied[replica] = None
+            replica_status = 502
+        if status == 200:
+            status = replica_status
+    return Response(json.dumps({"replicas": applied}), status=status, mimetype="application/json")
 
 
 if __name__ == "__main__":
-    logging.basicConfig(format="%(message)s", level=1 * 10)
-    logging.info("Start.")
-    app.run(host="0.0.0.0", threaded=True)
+    if os.environ.get("GATEWAY_ENGINE") == "async":
+        import async_app
+        async_app.main()
+    else:
+        configure_logging()
+        start_background_tasks()
+
+        logging.info("Start.")
+        app.run(host="0.0.0.0", threaded=True)
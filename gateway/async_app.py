@@ -0,0 +1,216 @@
+import asyncio
+import json
+import logging
+import time
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector, web
+from engine import CONNECT_TIMEOUT, READ_TIMEOUT, POOL_SIZE, CHUNK_SIZE, UPSTREAMS, cache, search_replicas, start_background_tasks, cached_answer
+from common.serving import configure_logging
+from common.metrics import render_metrics, request_duration
+
+
+def upstream_url(upstream):
+    # The search replicas are balanced, the other services have one address.
+    # None while no search replica is ready.
+    return search_replicas.choose() if upstream == "search" else UPSTREAMS[upstream]
+
+
+def error(status, description):
+    return web.Response(text=json.dumps({"result": False, "error": 3, "description": description}), status=status, content_type="application/json")
+
+
+async def forward(request, upstream, path):
+    cached, fill = cached_answer(request.path, request.query.items())
+    if cached is not None:
+        status, content_type, body = cached
+        return web.Response(body=body, status=status, headers={"Content-Type": content_type})
+
+    base = upstream_url(upstream)
+    if base is None:
+        return error(503, "No search replica is ready.")
+    url = base + path
+    if request.query_string:
+        url += "?" + request.query_string
+    logging.info(f"Requesting content from {url}...")
+
+    try:
+        if request.method == "POST":
+            # Bodies of batch writes are passed on as they are
+            upstream_response = await request.app["sessions"][upstream].post(url, data=await request.read(), headers={"Content-Type": request.content_type})
+        else:
+            upstream_response = await request.app["sessions"][upstream].get(url)
+    except asyncio.TimeoutError:
+        return error(504, "The service did not answer in time.")
+    except ClientError:
+        if upstream == "search":
+            search_replicas.failed(base)
+        return error(502, "The service is not reachable.")
+
+    # Pass the body through chunk by chunk instead of buffering it, small
+    # enough answers are collected on the way for the cache
+    async with upstream_response:
+        content_type = upstream_response.headers.get("Content-Type", "application/json")
+        response = web.StreamResponse(status=upstream_response.status, headers={"Content-Type": content_type})
+        await response.prepare(request)
+
+        async for chunk in upstream_response.content.iter_chunked(CHUNK_SIZE):
+            if fill is not None:
+                fill.add(chunk)
+            await response.write(chunk)
+        await response.write_eof()
+
+    if fill is not None:
+        fill.finish(upstream_response.status, content_type)
+    return response
+
+
+async def fetch_json(request, upstream, path, params=None):
+    base = upstream_url(upstream)
+    if base is None:
+        return 503, {"result": False, "error": 3, "description": "No search replica is ready."}
+    async with request.app["sessions"][upstream].get(base + path, params=params) as response:
+        return response.status, await response.json(content_type=None)
+
+
+async def standard(request):
+    return web.Response(text="Welcome to the Gateway Service!\nFrom here you can access all services!\nAppend:\n\"/apartments\" to interact with the apartment service\n\"reserve\" to interact with the reservation service\n\"search\" to interact with the searching service!")
+
+
+async def apartments(request):
+    return await forward(request, "apartments", request.path[len("/apartments"):])
+
+
+async def reserve(request):
+    return await forward(request, "reserve", request.path[len("/reserve"):])
+
+
+async def search(request):
+    return await forward(request, "search", request.path)
+
+
+async def overview(request):
+    # Apartment details and their availability, requested from both services
+    # at the same time
+    date = request.query.get("date")
+    duration = request.query.get("duration")
+    name = request.query.get("name")
+
+    if date is None or duration is None:
+        return web.Response(text='{"result": false, "error": 1, "description": "Cannot proceed because you did not provide date and duration for the overview."}', status=400, content_type="application/json")
+
+    try:
+        (apartments_status, apartments_data), (search_status, search_data) = await asyncio.gather(
+            fetch_json(request, "apartments", "/apartments"),
+            fetch_json(request, "search", "/search", {"date": date, "duration": duration}),
+        )
+    except asyncio.TimeoutError:
+        return error(504, "A service did not answer in time.")
+    except (ClientError, ValueError):
+        return error(502, "A service is not reachable.")
+
+    if search_status != 200:
+        return web.Response(text=json.dumps(search_data), status=search_status, content_type="application/json")
+    if apartments_status != 200:
+        return error(502, "The apartments service failed.")
+
+    available = set(entry["name"] for entry in search_data["apartments"])
+    rows = [dict(entry, available=entry["name"] in available) for entry in apartments_data["apartments"] if name is None or entry["name"] == name]
+    return web.Response(text=json.dumps({"apartments": rows}), status=200, content_type="application/json")
+
+
+async def health(request):
+    return web.Response(text='{"status": "ok"}', status=200, content_type="application/json")
+
+
+async def cache_stats(request):
+    return web.Response(text=json.dumps(cache.stats()), status=200, content_type="application/json")
+
+
+async def replicas_stats(request):
+    return web.Response(text=json.dumps({"search": search_replicas.stats()}), status=200, content_type="application/json")
+
+
+async def replicas_applied(request):
+    # Asks every ready search replica whether it applied an event (/applied
+    # with the same parameters), all at the same time. The first failure
+    # decides the status.
+    replicas = search_replicas.stats()["ready"]
+    if not replicas:
+        return error(503, "No search replica is ready.")
+
+    async def ask(replica):
+        try:
+            async with request.app["sessions"]["search"].get(replica + "/applied", params=request.query) as response:
+                return response.status, await response.json(content_type=None)
+        except (asyncio.TimeoutError, ClientError, ValueError):
+            return 502, None
+
+    answers = await asyncio.gather(*(ask(replica) for replica in replicas))
+    status = next((status for status, _ in answers if status != 200), 200)
+    return web.Response(text=json.dumps({"replicas": {replica: data for replica, (_, data) in zip(replicas, answers)}}), status=status, content_type="application/json")
+
+
+async def metrics(request):
+    return web.Response(text=render_metrics(), status=200, headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+@web.middleware
+async def time_requests(request, handler):
+    # Handlers stream the whole body before returning, so it is included
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else "unmatched"
+        request_duration.labels(route, request.method, str(status)).observe(time.perf_counter() - started)
+
+
+async def open_sessions(app):
+    timeout = ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+    app["sessions"] = {upstream: ClientSession(connector=TCPConnector(limit=POOL_SIZE), timeout=timeout) for upstream in UPSTREAMS}
+
+
+async def close_sessions(app):
+    for session in app["sessions"].values():
+        await session.close()
+
+
+def create_app():
+    app = web.Application(middlewares=[time_requests])
+    app.on_startup.append(open_sessions)
+    app.on_cleanup.append(close_sessions)
+
+    app.router.add_get("/", standard)
+    for path in ("/apartments/", "/apartments/add", "/apartments/delete", "/apartments/apartments"):
+        app.router.add_get(path, apartments)
+    for path in ("/reserve/", "/reserve/add", "/reserve/delete", "/reserve/reservations"):
+        app.router.add_get(path, reserve)
+    app.router.add_post("/apartments/add_batch", apartments)
+    app.router.add_post("/reserve/add_batch", reserve)
+    app.router.add_get("/search", search)
+    app.router.add_get("/search/flexible", search)
+    app.router.add_get("/overview", overview)
+    app.router.add_get("/health", health)
+    app.router.add_get("/cache/stats", cache_stats)
+    app.router.add_get("/replicas/stats", replicas_stats)
+    app.router.add_get("/replicas/applied", replicas_applied)
+    app.router.add_get("/metrics", metrics)
+    return app
+
+
+def main():
+    configure_logging()
+    start_background_tasks()
+
+    logging.info("Start (asyncio engine).")
+    web.run_app(create_app(), host="0.0.0.0", port=5000, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import itertools
+import logging
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+
+
+class ReplicaBalancer:
+    # Spreads the requests of a service round robin over its ready replicas.
+    # The replicas are found by resolving the host names of the configured
+    # URLs, docker compose resolves a scaled service to all its containers,
+    # and are probed at the readiness path in the background. A replica that
+    # cannot be reached is skipped until it passes a probe again.
+
+    def __init__(self, urls, path="/ready", interval=2, timeout=1):
+        self.urls = [url.rstrip("/") for url in urls]
+        self.path = path
+        self.interval = interval
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._ready = []
+        self._cycle = iter(())
+        self._failures = 0
+        self._checked = None
+
+    def start(self):
+        self.check()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception:
+                logging.exception("Could not check the replicas.")
+
+    def check(self):
+        ready = [replica for replica in self.resolve() if self.probe(replica)]
+        with self._lock:
+            if ready != self._ready:
+                logging.info(f"Ready replicas: {', '.join(ready) or 'none'}.")
+                self._ready = ready
+                self._cycle = itertools.cycle(ready)
+            self._checked = time.time()
+
+    def resolve(self):
+        replicas = []
+        for url in self.urls:
+            parts = urlsplit(url)
+            port = parts.port or 80
+            try:
+                addresses = sorted(set(info[4][0] for info in socket.getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM)))
+            except socket.gaierror:
+                continue
+            replicas.extend(f"{parts.scheme}://{address}:{port}" if ":" not in address else f"{parts.scheme}://[{address}]:{port}" for address in addresses)
+        return replicas
+
+    def probe(self, replica):
+        try:
+            return requests.get(replica + self.path, timeout=self.timeout).status_code == 200
+        except requests.RequestException:
+            return False
+
+    def choose(self):
+        # None while no replica is ready, a replica that is still catching
+        # up would answer from an incomplete read model
+        with self._lock:
+            if self._ready:
+                return next(self._cycle)
+        return None
+
+    def failed(self, replica):
+        with self._lock:
+            self._failures += 1
+            if replica in self._ready:
+                self._ready = [ready for ready in self._ready if ready != replica]
+                self._cycle = itertools.cycle(self._ready)
+
+    def stats(self):
+        with self._lock:
+            return {"ready": list(self._ready), "failures": self._failures, "checked": self._checked}
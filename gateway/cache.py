@@ -0,0 +1,131 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+import pika
+
+# Exchanges whose events change the answer of a cached route. Searches are
+# answered from the read models of the search replicas, which apply the
+# events later than the gateway receives them, so they are evicted once a
+# replica announces on search_applied that it applied events.
+ROUTE_DEPENDENCIES = {
+    "/apartments/apartments": ("apartments",),
+    "/reserve/reservations": ("reservations",),
+    "/search": ("search_applied",),
+    "/search/flexible": ("search_applied",),
+}
+
+
+def cache_key(path, parameters):
+    # Equivalent queries share one entry regardless of the parameter order
+    return path + "?" + urlencode(sorted(parameters))
+
+
+class ResponseCache:
+    # LRU cache of upstream answers with a time to live. Entries are evicted
+    # as soon as an event is published on an exchange they depend on. While
+    # the event subscription is down nothing is cached, since nothing could
+    # be evicted in time.
+
+    def __init__(self, size, ttl, max_entry_bytes):
+        self.size = size
+        self.ttl = ttl
+        self.max_entry_bytes = max_entry_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._subscribed = False
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.size > 0 and self._subscribed
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[1:4]
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def put(self, key, generation, status, content_type, body, dependencies):
+        with self._lock:
+            # An event arrived while the answer was requested, it may be stale
+            if generation != self._generation or not self._subscribed:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, status, content_type, body, dependencies)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, exchange):
+        with self._lock:
+            self._generation += 1
+            stale = [key for key, entry in self._entries.items() if exchange in entry[4]]
+            for key in stale:
+                del self._entries[key]
+            self._invalidations += len(stale)
+
+    def set_subscribed(self, subscribed):
+        with self._lock:
+            self._subscribed = subscribed
+            self._generation += 1
+            if not subscribed:
+                self._invalidations += len(self._entries)
+                self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.size > 0,
+                "subscribed": self._subscribed,
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+                "invalidations": self._invalidations,
+            }
+
+
+def subscribe_to_events(cache, host="rabbitmq"):
+    # Runs forever in a background thread
+    while True:
+        try:
+            connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
+            channel = connection.channel()
+            result = channel.queue_declare(queue="", exclusive=True)
+            queue_name = result.method.queue
+            for exchange in ("apartments", "reservations"):
+                channel.exchange_declare(exchange=exchange, exchange_type="direct", durable=True)
+                channel.queue_bind(exchange=exchange, queue=queue_name, routing_key="added")
+                channel.queue_bind(exchange=exchange, queue=queue_name, routing_key="deleted")
+            channel.exchange_declare(exchange="search_applied", exchange_type="fanout", durable=True)
+            channel.queue_bind(exchange="search_applied", queue=queue_name)
+            channel.basic_consume(queue=queue_name, on_message_callback=lambda ch, method, properties, body: cache.invalidate(method.exchange), auto_ack=True)
+
+            cache.set_subscribed(True)
+            logging.info("Response cache is listening for events.")
+            channel.start_consuming()
+        except Exception as e:
+            logging.warning(f"Response cache lost the message queue ({e!r}), retrying...")
+        cache.set_subscribed(False)
+        time.sleep(5)
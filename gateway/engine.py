@@ -0,0 +1,72 @@
+import os
+import threading
+from cache import ROUTE_DEPENDENCIES, ResponseCache, cache_key, subscribe_to_events
+from balancer import ReplicaBalancer
+
+# Configuration and state shared by both gateway engines, the threaded Flask
+# one (app.py) and the asyncio one (async_app.py)
+
+CONNECT_TIMEOUT = float(os.environ.get("GATEWAY_CONNECT_TIMEOUT", "3"))
+READ_TIMEOUT = float(os.environ.get("GATEWAY_READ_TIMEOUT", "30"))
+POOL_SIZE = int(os.environ.get("GATEWAY_POOL_SIZE", "32"))
+CHUNK_SIZE = 64 * 1024
+CACHE_SIZE = int(os.environ.get("GATEWAY_CACHE_SIZE", "0"))
+CACHE_TTL = float(os.environ.get("GATEWAY_CACHE_TTL", "30"))
+CACHE_MAX_ENTRY_BYTES = int(os.environ.get("GATEWAY_CACHE_MAX_ENTRY_BYTES", str(1024 * 1024)))
+SEARCH_UPSTREAMS = os.environ.get("GATEWAY_SEARCH_UPSTREAMS", "http://search:5000").split(",")
+HEALTH_INTERVAL = float(os.environ.get("GATEWAY_HEALTH_INTERVAL", "2"))
+
+UPSTREAMS = {
+    "apartments": "http://apartments:5000",
+    "reserve": "http://reserve:5000",
+    "search": "http://search:5000",
+}
+
+cache = ResponseCache(CACHE_SIZE, CACHE_TTL, CACHE_MAX_ENTRY_BYTES)
+search_replicas = ReplicaBalancer(SEARCH_UPSTREAMS, interval=HEALTH_INTERVAL)
+
+
+def start_background_tasks():
+    # Every process has its own cache and therefore its own subscription,
+    # and probes the search replicas on its own
+    if CACHE_SIZE > 0:
+        threading.Thread(target=subscribe_to_events, args=(cache,), daemon=True).start()
+    search_replicas.start()
+
+
+def cached_answer(path, query):
+    # Read routes are answered from the cache when possible. Returns the
+    # cached (status, content_type, body), or None and, for a read route, the
+    # CacheFill the answer of the upstream is passed through
+    dependencies = ROUTE_DEPENDENCIES.get(path)
+    if dependencies is None or not cache.enabled:
+        return None, None
+    key = cache_key(path, query)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached, None
+    return None, CacheFill(key, cache.generation(), dependencies)
+
+
+class CacheFill:
+    # Collects the chunks of an answer while they are streamed to the client,
+    # as long as it stays small enough for the cache. Answers other than 200
+    # are not cached.
+
+    def __init__(self, key, generation, dependencies):
+        self.key = key
+        self.generation = generation
+        self.dependencies = dependencies
+        self.body = []
+        self.size = 0
+        self.cacheable = True
+
+    def add(self, chunk):
+        if self.cacheable:
+            self.size += len(chunk)
+            self.cacheable = self.size <= cache.max_entry_bytes
+            self.body.append(chunk)
+
+    def finish(self, status, content_type):
+        if self.cacheable and status == 200:
+            cache.put(self.key, self.generation, status, content_type, b"".join(self.body), self.dependencies)
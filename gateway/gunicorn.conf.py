@@ -0,0 +1,21 @@
+import os
+from common.serving import configure_logging
+
+wsgi_app = "app:app"
+bind = "0.0.0.0:5000"
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_WORKERS", "2"))
+threads = int(os.environ.get("WEB_THREADS", "8"))
+graceful_timeout = int(os.environ.get("WEB_GRACEFUL_TIMEOUT", "30"))
+
+if os.environ.get("GATEWAY_ENGINE") == "async":
+    wsgi_app = "async_app:create_app()"
+    worker_class = "aiohttp.GunicornWebWorker"
+
+
+def post_worker_init(worker):
+    configure_logging()
+
+    # Every worker has its own response cache, the same for both engines
+    import engine
+    engine.start_background_tasks()
@@ -1,8 +1,8 @@
-import sqlite3
 import uuid
 from flask import request
 from flask import Flask
 from flask import Response
+from flask import stream_with_context
 import logging
 import pika
 import json
@@ -11,19 +11,34 @@ import os
 from datetime import datetime
 import threading
 import requests
-from opentelemetry import trace
-from opentelemetry . sdk . trace import TracerProvider
-from opentelemetry . sdk . trace . export import BatchSpanProcessor
-from opentelemetry . exporter . otlp . proto . http . trace_exporter import OTLPSpanExporter
-from opentelemetry . instrumentation . requests import RequestsInstrumentor
-from opentelemetry . instrumentation . flask import FlaskInstrumentor
+from common.db import ConnectionPool
+from common.publisher import EventPublisher
+from common.encoding import decode_event
+from common.outbox import setup_outbox, add_to_outbox, stream_outbox, OutboxRelay
+from common.consumer import declare_queue, consume_in_batches, consume_with_reconnects, replay_events, read_offsets, applied_response
+from common.events import setup_sequence, next_sequence, next_sequences, setup_offsets, setup_versions, claim_version
+from common.migrations import migrate, rebuild_table
+from common.periods import latest_end, update_max_ends, update_all_max_ends
+from common.batch import read_items, batch_status, item_value
+from common.snapshot import stream_snapshot, load_snapshot
+from common.serving import configure_logging, mark_failed, has_failed
+from common.tracing import setup_tracing, shutdown_tracing
+from common.metrics import instrument_app, render_metrics, query_duration
+
+QUEUE_NAME = os.environ.get("MQ_QUEUE_NAME", "reserve")
+BINDINGS = [("apartments", "added"), ("apartments", "deleted")]
 
 app = Flask(__name__)
+db_pool = ConnectionPool("/home/data/reservations.db")
+# The relay marks events as sent once the broker confirmed them
+publisher = EventPublisher(exchanges=("reservations",), confirms=True)
+relay = OutboxRelay(db_pool, publisher)
+bootstrapped = threading.Event()
+stopping = threading.Event()
+consumer_thread = None
 
-trace.set_tracer_provider(TracerProvider())
-trace.get_tracer_provider().add_span_processor(BatchSpanProcessor(OTLPSpanExporter())) 
-FlaskInstrumentor().instrument_app(app)
-RequestsInstrumentor().instrument()
+setup_tracing(app)
+instrument_app(app)
 
 @app.route("/add")
 def add():
@@ -39,45 +54,121 @@ def add():
     vip_as_integer = 1 if vip == "1" else 0
 
     # Connect and setup the database
-    db_connection = sqlite3.connect("/home/data/reservations.db", isolation_level=None)
-    cursor = db_connection.cursor()
-
-    cursor.execute("SELECT id FROM apartments WHERE name = ?", (apartment,))
-    appartment_id = cursor.fetchone()
-    if appartment_id == None:
-        return Response('{"result": false, "error": 2, "description": "Cannot proceed because this apartment does not exist"}', status=400, mimetype="application/json")
-
-    appartment_id = appartment_id[0]
-
-    start_as_datetime = datetime.strptime(start, "%Y%m%d")
-    from_as_timestamp = start_as_datetime.timestamp()
-    to_as_timestamp = from_as_timestamp + int(duration) * 24 * 60 * 60
-
-    # Check if appartement is already reserved during the indicated period
-    logging.info(f"Trying to insert a reservation for apartment {appartment_id} from {from_as_timestamp} ({datetime.fromtimestamp(from_as_timestamp).isoformat()}) to {to_as_timestamp} ({datetime.fromtimestamp(to_as_timestamp).isoformat()})")
-    
-    cursor.execute("SELECT COUNT(id) FROM reservations WHERE apartment = ? AND ((period_from < ? AND period_to > ?) OR (period_from < ? AND period_to > ?) OR (period_from <= ? AND period_to >= ?))", (appartment_id, from_as_timestamp, from_as_timestamp, to_as_timestamp, to_as_timestamp, from_as_timestamp, to_as_timestamp))
-    already_exists = cursor.fetchone()[0]
-    if already_exists > 0:
-        logging.info("Rejecting reservation, since apartment is already taken during the requested period.")
-        return Response('{"result": false, "error": 2, "description": "Cannot proceed because this apartment is already reserved"}', status=400, mimetype="application/json")
-
-    # Add appartement
-    logging.info("Accepting reservation, since apartment is free during the requested period.")
-    cursor.execute("INSERT INTO reservations (id, apartment, period_from, period_to, vip) VALUES (?, ?, ?, ?, ?)", (str(id), appartment_id, from_as_timestamp, to_as_timestamp, vip_as_integer))
-    cursor.close()
-    db_connection.close()
-
-    # Notify everybody that the apartment was added
-    mq_connection = pika.BlockingConnection(pika.ConnectionParameters("rabbitmq"))
-    channel = mq_connection.channel()
-    channel.exchange_declare(exchange="reservations", exchange_type="direct")
-
-    data_to_send = {"id": str(id), "apartment": appartment_id, "from": from_as_timestamp, "to": to_as_timestamp}
-    channel.basic_publish(exchange="reservations", routing_key="added", body=json.dumps(data_to_send))
-    mq_connection.close()
-
-    return Response('{"result": true, "description": "Reservation was added successfully.", "id": "' + str(id) + '"}', status=201, mimetype="application/json")
+    with db_pool.connection() as db_connection:
+        cursor = db_connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+
+        cursor.execute("SELECT id FROM apartments WHERE name = ?", (apartment,))
+        appartment_id = cursor.fetchone()
+        if appartment_id == None:
+            return Response('{"result": false, "error": 2, "description": "Cannot proceed because this apartment does not exist"}', status=400, mimetype="application/json")
+
+        appartment_id = appartment_id[0]
+
+        start_as_datetime = datetime.strptime(start, "%Y%m%d")
+        from_as_timestamp = start_as_datetime.timestamp()
+        to_as_timestamp = from_as_timestamp + int(duration) * 24 * 60 * 60
+
+        # Check if appartement is already reserved during the indicated period
+        logging.info(f"Trying to insert a reservation for apartment {appartment_id} from {from_as_timestamp} ({datetime.fromtimestamp(from_as_timestamp).isoformat()}) to {to_as_timestamp} ({datetime.fromtimestamp(to_as_timestamp).isoformat()})")
+
+        if is_reserved(cursor, appartment_id, from_as_timestamp, to_as_timestamp):
+            logging.info("Rejecting reservation, since apartment is already taken during the requested period.")
+            return Response('{"result": false, "error": 2, "description": "Cannot proceed because this apartment is already reserved"}', status=400, mimetype="application/json")
+
+        # Add appartement
+        logging.info("Accepting reservation, since apartment is free during the requested period.")
+        cursor.execute("INSERT INTO reservations (id, apartment, period_from, period_to, vip) VALUES (?, ?, ?, ?, ?)", (str(id), appartment_id, from_as_timestamp, to_as_timestamp, vip_as_integer))
+        update_max_ends(cursor, appartment_id, from_as_timestamp)
+        sequence = next_sequence(cursor)
+
+        # Notify everybody that the reservation was added, once committed
+        data_to_send = {"id": str(id), "apartment": appartment_id, "from": from_as_timestamp, "to": to_as_timestamp, "event_id": str(uuid.uuid4()), "version": sequence, "sequence": sequence, "timestamp": time.time()}
+        add_to_outbox(cursor, "reservations", "added", data_to_send)
+        cursor.execute("COMMIT")
+        cursor.close()
+    relay.wake()
+
+    return Response('{"result": true, "description": "Reservation was added successfully.", "id": "' + str(id) + '", "sequence": ' + str(sequence) + '}', status=201, mimetype="application/json")
+
+
+def is_reserved(cursor, appartment_id, from_as_timestamp, to_as_timestamp):
+    # Two periods overlap if each starts before the other ends. The check
+    # and the insert following it run in one BEGIN IMMEDIATE transaction,
+    # which holds the write lock of the database, so no other booking can
+    # slip in between. It is a single seek in the reservations_period index,
+    # see common/periods.py.
+    with query_duration.labels("reserve_conflict").time():
+        latest = latest_end(cursor, appartment_id, to_as_timestamp)
+        return latest != None and latest > from_as_timestamp
+
+
+@app.route("/add_batch", methods=["POST"])
+def add_batch():
+    # Adds many reservations in one transaction, every item is validated on
+    # its own and gets its own result. Items are checked against each other
+    # as well, in the order they were sent.
+    try:
+        items = read_items(request.get_data())
+    except ValueError as e:
+        return Response(json.dumps({"result": False, "error": 1, "description": f"Cannot proceed because the body is not a JSON array or NDJSON of reservations. {e}"}), status=400, mimetype="application/json")
+
+    results = []
+    rows = []
+    with db_pool.connection() as db_connection:
+        cursor = db_connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+
+        apartment_ids = {}
+        for index, item in enumerate(items):
+            apartment = item_value(item, "name")
+            start = item_value(item, "start")
+            duration = item_value(item, "duration")
+            vip = item_value(item, "vip")
+
+            if apartment == None or start == None or duration == None or vip == None:
+                results.append({"index": index, "result": False, "error": 1, "description": "Cannot proceed because you did not provide name, start, duration and vip status for the reservation."})
+                continue
+
+            try:
+                from_as_timestamp = datetime.strptime(start, "%Y%m%d").timestamp()
+                to_as_timestamp = from_as_timestamp + int(duration) * 24 * 60 * 60
+            except ValueError:
+                results.append({"index": index, "result": False, "error": 2, "description": "Start is not a date (Ymd) or duration is not a number."})
+                continue
+
+            if apartment not in apartment_ids:
+                cursor.execute("SELECT id FROM apartments WHERE name = ?", (apartment,))
+                row = cursor.fetchone()
+                apartment_ids[apartment] = row[0] if row != None else None
+            appartment_id = apartment_ids[apartment]
+            if appartment_id == None:
+                results.append({"index": index, "result": False, "error": 2, "description": "Cannot proceed because this apartment does not exist"})
+                continue
+
+            if is_reserved(cursor, appartment_id, from_as_timestamp, to_as_timestamp):
+                results.append({"index": index, "result": False, "error": 2, "description": "Cannot proceed because this apartment is already reserved"})
+                continue
+
+            id = str(uuid.uuid4())
+            cursor.execute("INSERT INTO reservations (id, apartment, period_from, period_to, vip) VALUES (?, ?, ?, ?, ?)", (id, appartment_id, from_as_timestamp, to_as_timestamp, 1 if vip == "1" else 0))
+            update_max_ends(cursor, appartment_id, from_as_timestamp)
+            rows.append((id, appartment_id, from_as_timestamp, to_as_timestamp))
+            results.append({"index": index, "result": True, "description": "Reservation was added successfully.", "id": id})
+
+        # Notify everybody about all added reservations, once committed
+        if rows:
+            sequences = next_sequences(cursor, len(rows))
+            timestamp = time.time()
+            for (id, appartment_id, from_as_timestamp, to_as_timestamp), sequence, result in zip(rows, sequences, (result for result in results if result["result"])):
+                add_to_outbox(cursor, "reservations", "added", {"id": id, "apartment": appartment_id, "from": from_as_timestamp, "to": to_as_timestamp, "event_id": str(uuid.uuid4()), "version": sequence, "sequence": sequence, "timestamp": timestamp})
+                result["sequence"] = sequence
+        cursor.execute("COMMIT")
+        cursor.close()
+    relay.wake()
+
+    logging.info(f"Added {len(rows)} of {len(items)} reservations in one batch.")
+    return Response(json.dumps({"result": len(rows) == len(items), "added": len(rows), "items": results}), status=batch_status(results), mimetype="application/json")
 
 
 @app.route("/delete")
@@ -88,30 +179,29 @@ def delete():
         return Response('{"result": false, "error": 1, "description": "Cannot proceed because you did not provide the id of the reservation."}', status=400, mimetype="application/json")
 
     # Connect and setup the database
-    db_connection = sqlite3.connect("/home/data/reservations.db", isolation_level=None)
-    cursor = db_connection.cursor()
-
-    # Check if reservation exists
-    cursor.execute("SELECT COUNT(id) FROM reservations WHERE id = ?", (id,))
-    already_exists = cursor.fetchone()[0]
-    if already_exists == 0:
-        return Response('{"result": false, "error": 2, "description": "Cannot proceed because this reservation does not exist"}', status=400, mimetype="application/json")
+    with db_pool.connection() as db_connection:
+        cursor = db_connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
 
-    # Add appartement
-    cursor.execute("DELETE FROM reservations WHERE id = ?", (id,))
-    cursor.close()
-    db_connection.close()
+        # Check if reservation exists
+        cursor.execute("SELECT apartment, period_from FROM reservations WHERE id = ?", (id,))
+        reservation = cursor.fetchone()
+        if reservation == None:
+            return Response('{"result": false, "error": 2, "description": "Cannot proceed because this reservation does not exist"}', status=400, mimetype="application/json")
 
-    # Notify everybody that the apartment was added
-    mq_connection = pika.BlockingConnection(pika.ConnectionParameters("rabbitmq"))
-    channel = mq_connection.channel()
-    channel.exchange_declare(exchange="reservations", exchange_type="direct")
+        # Delete the reservation, the ones after it may have ended earlier
+        cursor.execute("DELETE FROM reservations WHERE id = ?", (id,))
+        update_max_ends(cursor, *reservation)
+        sequence = next_sequence(cursor)
 
-    data_to_send = {"id": id}
-    channel.basic_publish(exchange="reservations", routing_key="deleted", body=json.dumps(data_to_send))
-    mq_connection.close()
+        # Notify everybody that the reservation was deleted, once committed
+        data_to_send = {"id": id, "event_id": str(uuid.uuid4()), "version": sequence, "sequence": sequence, "timestamp": time.time()}
+        add_to_outbox(cursor, "reservations", "deleted", data_to_send)
+        cursor.execute("COMMIT")
+        cursor.close()
+    relay.wake()
 
-    return Response('{"result": true, "description": "Reservation was deleted successfully."}', status=201, mimetype="application/json")
+    return Response('{"result": true, "description": "Reservation was deleted successfully.", "sequence": ' + str(sequence) + '}', status=201, mimetype="application/json")
 
 
 @app.route("/")
@@ -121,17 +211,58 @@ def hello():
 
 @app.route("/reservations")
 def reservations():
-    if os.path.exists("/home/data/reservations.db"):
-        db_connection = sqlite3.connect("/home/data/reservations.db", isolation_level=None)
-        cursor = db_connection.cursor()
-        cursor.execute("SELECT id, apartment, period_from, period_to, vip FROM reservations")
-        columns = [col[0] for col in cursor.description]
-        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    if os.path.exists(db_pool.path):
+        with db_pool.connection() as db_connection:
+            cursor = db_connection.cursor()
+            cursor.execute("SELECT id, apartment, period_from, period_to, vip FROM reservations")
+            columns = [col[0] for col in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            cursor.close()
         return Response(json.dumps({"reservations": rows}), status=200, mimetype="application/json")
 
     return Response(json.dumps({"reservations": []}), status=200, mimetype="application/json")
 
 
+@app.route("/snapshot")
+def snapshot():
+    return Response(stream_with_context(stream_snapshot(db_pool, "SELECT id, apartment, period_from, period_to, vip FROM reservations")), status=200, mimetype="application/x-ndjson")
+
+
+@app.route("/events")
+def events():
+    # The events after the given sequence, for consumers whose queue missed them
+    after = request.args.get("after", "0")
+
+    if not after.isdigit():
+        return Response('{"result": false, "error": 1, "description": "Cannot proceed because after is not a sequence number."}', status=400, mimetype="application/json")
+
+    return Response(stream_with_context(stream_outbox(db_pool, int(after))), status=200, mimetype="application/x-ndjson")
+
+
+@app.route("/stats")
+def stats():
+    return Response(json.dumps({"db_pool": db_pool.stats(), "publisher": publisher.stats(), "outbox": relay.stats()}), status=200, mimetype="application/json")
+
+
+@app.route("/applied")
+def applied():
+    return applied_response(db_pool, request.args)
+
+
+@app.route("/metrics")
+def metrics():
+    return Response(render_metrics(), status=200, content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route("/health")
+def health():
+    # Any worker can answer this, the worker running the consumer records
+    # if it stopped for good
+    if has_failed("reserve"):
+        return Response('{"status": "consumer stopped"}', status=503, mimetype="application/json")
+    return Response('{"status": "ok"}', status=200, mimetype="application/json")
+
+
 def connect_to_mq():
     while True:
         time.sleep(10)
@@ -143,49 +274,51 @@ def connect_to_mq():
 
 
 def apartment_added(ch, method, properties, body):
-    data = json.loads(body)
+    data = decode_event(body, properties)
     id = data["id"]
     name = data["name"]
 
     logging.info(f"Adding apartment {name}...")
 
-    db_connection = sqlite3.connect("/home/data/reservations.db", isolation_level=None)
-    cursor = db_connection.cursor()
-    cursor.execute("INSERT INTO apartments VALUES (?, ?)", (id, name))
-    cursor.close()
-    db_connection.close()
+    with db_pool.connection() as db_connection:
+        db_connection.execute("INSERT INTO apartments VALUES (?, ?)", (id, name))
 
 def apartment_deleted(ch, method, properties, body):
-    data = json.loads(body)
+    data = decode_event(body, properties)
     name = data["name"]
 
     logging.info(f"Deleting apartment {name}...")
 
-    db_connection = sqlite3.connect("/home/data/reservations.db", isolation_level=None)
-    cursor = db_connection.cursor()
-    cursor.execute("DELETE FROM apartments WHERE name = ?", (name, ))
-    cursor.execute("DELETE FROM reservations WHERE apartment = ?", (name, ))
-    cursor.close()
-    db_connection.close()
+    with db_pool.connection() as db_connection:
+        db_connection.execute("DELETE FROM apartments WHERE name = ?", (name, ))
+        db_connection.execute("DELETE FROM reservations WHERE apartment = ?", (name, ))
 
-def listen_to_events(channel):
-    channel.start_consuming()
+def listen_to_events(mq_connection, channel, queue_name):
+    def consume(channel):
+        consume_in_batches(channel, queue_name, db_pool, apartment_changed, ready=bootstrapped, stopping=stopping)
 
-def apartment_changed(ch, method, properties, body):
-    data = json.loads(body)
+    try:
+        consume_with_reconnects(mq_connection, channel, queue_name, BINDINGS, connect_to_mq, consume, stopping, recreated=lambda: bootstrap(True))
+    finally:
+        if not stopping.is_set():
+            logging.error("The event consumer stopped, the service is unhealthy.")
+            mark_failed("reserve", True)
 
+def apartment_changed(db_connection, method, properties, data):
+    # Apartments are identified by name, redelivered and stale events about
+    # one are skipped
     if method.exchange == "apartments":
+        if not claim_version(db_connection, method.exchange, data["name"], data.get("version"), deleted=method.routing_key == "deleted"):
+            logging.info(f"Skipping stale event {data.get('event_id')} about apartment {data['name']}.")
+            return
+
         if method.routing_key == "added":
             id = data["id"]
             name = data["name"]
 
             logging.info(f"Adding apartment {name}...")
 
-            db_connection = sqlite3.connect("/home/data/reservations.db", isolation_level=None)
-            cursor = db_connection.cursor()
-            cursor.execute("INSERT INTO apartments VALUES (?, ?)", (id, name))
-            cursor.close()
-            db_connection.close()
+            db_connection.execute("INSERT INTO apartments (id, name) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET name = excluded.name", (id, name))
 
 
         if method.routing_key == "deleted":
@@ -193,64 +326,127 @@ def apartment_changed(ch, method, properties, body):
 
             logging.info(f"Deleting apartment {name}...")
 
-            db_connection = sqlite3.connect("/home/data/reservations.db", isolation_level=None)
-            cursor = db_connection.cursor()
-            cursor.execute("DELETE FROM apartments WHERE name = ?", (name,))
-            cursor.close()
-            db_connection.close()
+            db_connection.execute("DELETE FROM apartments WHERE name = ?", (name,))
+
+# Schema versions, applied in order at startup to new and existing files
+MIGRATIONS = [
+    [
+        "CREATE TABLE IF NOT EXISTS reservations (id text, apartment text, period_from integer, period_to integer, vip integer)",
+        "CREATE TABLE IF NOT EXISTS apartments (id text, name text)",
+        "CREATE INDEX IF NOT EXISTS reservations_period ON reservations (apartment, period_from, period_to)",
+    ],
+    # Keys: the ids are primary keys and apartments are looked up by name.
+    # Rebuilding a table drops its indexes, they are created again.
+    [
+        lambda db_connection: rebuild_table(db_connection, "reservations", "id text PRIMARY KEY, apartment text NOT NULL, period_from integer NOT NULL, period_to integer NOT NULL, vip integer", "id, apartment, period_from, period_to, vip"),
+        "CREATE INDEX reservations_period ON reservations (apartment, period_from, period_to)",
+        lambda db_connection: rebuild_table(db_connection, "apartments", "id text PRIMARY KEY, name text NOT NULL", "id, name"),
+        "CREATE INDEX apartments_name ON apartments (name)",
+    ],
+    # The latest end up to each reservation, so that the conflict check is a
+    # single seek even if legacy reservations overlap (see common/periods.py)
+    [
+        "ALTER TABLE reservations ADD COLUMN max_end integer",
+        update_all_max_ends,
+        "DROP INDEX reservations_period",
+        "CREATE INDEX reservations_period ON reservations (apartment, period_from, max_end, period_to)",
+    ],
+]
+
+# Hot queries whose plans are compared when migrating
+QUERY_PLANS = {
+    "apartment_by_name": ("SELECT id FROM apartments WHERE name = ?", (None,)),
+    "reserve_conflict": ("SELECT max_end FROM reservations WHERE apartment = ? AND period_from < ? ORDER BY period_from DESC, max_end DESC LIMIT 1", (None, None)),
+    "reservation_exists": ("SELECT apartment, period_from FROM reservations WHERE id = ?", (None,)),
+    "reservation_delete": ("DELETE FROM reservations WHERE id = ?", (None,)),
+    "apartment_delete": ("DELETE FROM apartments WHERE name = ?", (None,)),
+}
+
+def setup_database():
+    with db_pool.connection() as db_connection:
+        migrate(db_connection, MIGRATIONS, QUERY_PLANS)
+        setup_sequence(db_connection)
+        setup_outbox(db_connection)
+        setup_offsets(db_connection)
+        setup_versions(db_connection)
 
 def load_all_apartments_from_db():
-    db_connection = sqlite3.connect("/home/data/reservations.db", isolation_level=None)
-    cursor = db_connection.cursor()
-    cursor.execute("CREATE TABLE IF NOT EXISTS reservations (id text, apartment text, period_from integer, period_to integer, vip integer)")
-    cursor.execute("CREATE TABLE IF NOT EXISTS apartments (id text, name text)")
-    
+    with db_pool.connection() as db_connection:
+        while True:
+            try:
+                db_connection.execute("BEGIN IMMEDIATE")
+                db_connection.execute("DELETE FROM apartments")
+                count, offset = load_snapshot(db_connection, "http://apartments:5000/snapshot", "apartments", "INSERT INTO apartments VALUES (?, ?)", lambda entry: (entry["id"], entry["name"]))
+                db_connection.execute("COMMIT")
+                logging.info(f"Loaded {count} apartments up to event {offset}.")
+                break
+            except Exception as e:
+                if db_connection.in_transaction:
+                    db_connection.execute("ROLLBACK")
+                print(e)
+                logging.warning("Apartments is down, reconnecting...")
+                time.sleep(5)
+
+def replay_apartments():
+    # True if the missed events were replayed, False if the outbox of the
+    # apartments service no longer holds all of them
     while True:
         try:
-            data = requests.get(f"http://apartments:5000/apartments").json()
-            for entry in data["apartments"]:
-                cursor.execute("INSERT INTO apartments VALUES (?, ?)", (entry["id"], entry["name"]))
-            break
-        except Exception as e:
-            print(e)
+            return replay_events(db_pool, "http://apartments:5000/events", "apartments", apartment_changed) != None
+        except requests.RequestException:
             logging.warning("Apartments is down, reconnecting...")
             time.sleep(5)
-            
-    cursor.close()
-    db_connection.close()
 
-if __name__ == "__main__":
-    logging.basicConfig(format="%(message)s", level=1 * 10)
-    logging.getLogger("pika").setLevel(logging.WARNING)
-    logging.getLogger("sqlite3").setLevel(logging.WARNING)
+def initialize():
+    mark_failed("reserve", False)
+    setup_database()
+    relay.start()
 
     mq_connection = connect_to_mq()
+    channel, queue_created = declare_queue(mq_connection, QUEUE_NAME, BINDINGS)
 
-    channel = mq_connection.channel()
-    channel.exchange_declare(exchange="apartments", exchange_type="direct")
-    result = channel.queue_declare(queue="", exclusive=True)
-    queue_name = result.method.queue
-    channel.queue_bind(exchange="apartments", queue=queue_name, routing_key="added")
-    channel.queue_bind(exchange="apartments", queue=queue_name, routing_key="deleted")
-    channel.basic_consume(queue=queue_name, on_message_callback=apartment_changed, auto_ack=True)
-    
     logging.info("Waiting for messages.")
-    
-    thread = threading.Thread(target=listen_to_events, args=(channel,), daemon=True)
-    thread.start()
-
-    database_is_initialized = False
-    if os.path.exists("/home/data/reservations.db"):
-        database_is_initialized = True
-    else:
+
+    # Events are only applied once the read model caught up, the ones that
+    # are already part of it are skipped
+    global consumer_thread
+    consumer_thread = threading.Thread(target=listen_to_events, args=(mq_connection, channel, QUEUE_NAME), daemon=True)
+    consumer_thread.start()
+
+    bootstrap(queue_created)
+    bootstrapped.set()
+
+
+def bootstrap(queue_created):
+    # A new database is loaded from a snapshot. An existing one only missed
+    # events if the queue had to be created anew, these are replayed from
+    # the outbox of the apartments service, or loaded from a snapshot if it
+    # was pruned already.
+    offsets = read_offsets(db_pool)
+    if "apartments" not in offsets or (queue_created and not replay_apartments()):
         load_all_apartments_from_db()
-        database_is_initialized = True
 
-    if not database_is_initialized:
-        logging.error("Cannot initialize database.")
-    else:
-        try:
-            logging.info("Start.")
-            app.run(host="0.0.0.0", threaded=True)
-        finally:
-            mq_connection.close()
+
+def start_background_tasks():
+    threading.Thread(target=initialize, daemon=True).start()
+
+
+def stop_background_tasks():
+    stopping.set()
+    if consumer_thread is not None:
+        consumer_thread.join(timeout=10)
+    relay.stop()
+    db_pool.close()
+    publisher.close()
+    shutdown_tracing()
+
+
+if __name__ == "__main__":
+    configure_logging()
+
+    initialize()
+    try:
+        logging.info("Start.")
+        app.run(host="0.0.0.0", threaded=True)
+    finally:
+        stop_background_tasks()
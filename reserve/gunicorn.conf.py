@@ -0,0 +1,26 @@
+import os
+from common.serving import configure_logging, elect_background_worker
+
+wsgi_app = "app:app"
+bind = "0.0.0.0:5000"
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_WORKERS", "2"))
+threads = int(os.environ.get("WEB_THREADS", "8"))
+graceful_timeout = int(os.environ.get("WEB_GRACEFUL_TIMEOUT", "30"))
+
+
+def post_worker_init(worker):
+    import app
+    configure_logging()
+
+    # Every worker serves writes, the tables have to exist before the first
+    app.setup_database()
+
+    # The event consumer has to run exactly once per container
+    if elect_background_worker("reserve"):
+        app.start_background_tasks()
+
+
+def worker_exit(server, worker):
+    import app
+    app.stop_background_tasks()
@@ -1,4 +1,3 @@
-import sqlite3
 import logging
 import pika
 import time
@@ -10,26 +9,53 @@ from flask import Response
 import os
 from datetime import datetime
 import requests
-from opentelemetry import trace
-from opentelemetry . sdk . trace import TracerProvider
-from opentelemetry . sdk . trace . export import BatchSpanProcessor
-from opentelemetry . exporter . otlp . proto . http . trace_exporter import OTLPSpanExporter
-from opentelemetry . instrumentation . requests import RequestsInstrumentor
-from opentelemetry . instrumentation . flask import FlaskInstrumentor
+from common.db import ConnectionPool
+from common.consumer import declare_queue, replica_queue_name, consume_in_batches, consume_with_reconnects, replay_events, read_offsets, applied_response
+from common.events import setup_offsets, setup_versions, claim_version
+from common.migrations import migrate, rebuild_table
+from common.periods import update_max_ends, update_all_max_ends
+from common.snapshot import load_snapshot
+from common.serving import configure_logging, mark_ready, is_ready, mark_failed, has_failed
+from common.tracing import setup_tracing, shutdown_tracing
+from common.metrics import instrument_app, render_metrics, query_duration
+from availability import AvailabilityIndex, free_windows, DAY
+
+SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND", "memory")
+FLEXIBLE_MAX_DAYS = 366
+FLEXIBLE_MAX_DURATIONS = 31
+# Every replica keeps its own read model and therefore needs its own queue,
+# named after its database unless given
+QUEUE_NAME = os.environ.get("MQ_QUEUE_NAME")
+BINDINGS = [(exchange, routing_key) for exchange in ("apartments", "reservations") for routing_key in ("added", "deleted")]
 
 app = Flask(__name__)
+db_pool = ConnectionPool("/home/data/search.db")
+availability = AvailabilityIndex()
+projection_lock = threading.Lock()
+bootstrapped = threading.Event()
+caught_up = threading.Event()
+stopping = threading.Event()
+consumer_thread = None
 
-trace.set_tracer_provider(TracerProvider())
-trace.get_tracer_provider().add_span_processor(BatchSpanProcessor(OTLPSpanExporter())) 
-FlaskInstrumentor().instrument_app(app)
-RequestsInstrumentor().instrument()
+setup_tracing(app)
+instrument_app(app)
 
 @app.route("/")
 def hello():
     return "Hello World from the search service!"
 
+def serving():
+    # Searches are answered once the read model is loaded, by the worker
+    # running the consumer or, with the sqlite backend, by the other workers
+    # once it caught up
+    return bootstrapped.is_set() or is_ready("search")
+
+
 @app.route("/search")
 def search():
+    if not serving():
+        return Response('{"result": false, "error": 3, "description": "The read model is still being loaded."}', status=503, mimetype="application/json")
+
     start = request.args.get("date")
     duration = request.args.get("duration")
 
@@ -38,46 +64,115 @@ def search():
 
     start_as_datetime = datetime.strptime(start, "%Y%m%d")
     from_as_timestamp = start_as_datetime.timestamp()
-    to_as_timestamp = from_as_timestamp + int(duration) * 24 * 60
+    to_as_timestamp = from_as_timestamp + int(duration) * 24 * 60 * 60
 
     logging.info(f"Searching for appartments not reserved from {from_as_timestamp} to {to_as_timestamp}...")
 
-    db_connection = sqlite3.connect("/home/data/search.db", isolation_level=None)
-    cursor = db_connection.cursor()
-    cursor.execute("SELECT name FROM apartments WHERE id NOT IN (SELECT apartment FROM reservations WHERE ((period_from < ? AND period_to > ?) OR (period_from < ? AND period_to > ?) OR (period_from <= ? AND period_to >= ?)))", (from_as_timestamp, from_as_timestamp, to_as_timestamp, to_as_timestamp, from_as_timestamp, to_as_timestamp))
-    columns = [col[0] for col in cursor.description]
-    rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
-    cursor.close()
-    db_connection.close()
+    if SEARCH_BACKEND == "memory":
+        with query_duration.labels("search_memory").time():
+            rows = [{"name": name} for name in availability.free_apartments(from_as_timestamp, to_as_timestamp)]
+        return Response(json.dumps({"apartments": rows}), status=200, mimetype="application/json")
+
+    # An apartment is free if the latest end of its reservations starting
+    # before the requested end is not after the requested start, one seek in
+    # the availability index per apartment (see common/periods.py). Without
+    # such reservations the comparison is NULL and the apartment free.
+    with db_pool.connection() as db_connection:
+        cursor = db_connection.cursor()
+        with query_duration.labels("search_overlap").time():
+            cursor.execute("SELECT name FROM apartments WHERE NOT IFNULL((SELECT max_end FROM reservations WHERE apartment = apartments.id AND period_from < ? ORDER BY period_from DESC, max_end DESC LIMIT 1) > ?, 0)", (to_as_timestamp, from_as_timestamp))
+            columns = [col[0] for col in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        cursor.close()
     return Response(json.dumps({"apartments": rows}), status=200, mimetype="application/json")
 
 
-def apartment_or_reservations_changed(ch, method, properties, body):
-    data = json.loads(body)
+@app.route("/search/flexible")
+def search_flexible():
+    # Every window of the given durations in which an apartment is free,
+    # between the earliest check-in (from) and the latest check-out (to).
+    # All windows are found in one sweep over the reservations.
+    if not serving():
+        return Response('{"result": false, "error": 3, "description": "The read model is still being loaded."}', status=503, mimetype="application/json")
+
+    start = request.args.get("from")
+    end = request.args.get("to")
+    durations = request.args.get("durations")
+    min_size = request.args.get("min_size")
+
+    if start == None or end == None or durations == None:
+        return Response('{"result": false, "error": 1, "description": "Cannot proceed because you did not provide from, to and durations for the search."}', status=400, mimetype="application/json")
+
+    try:
+        from_as_timestamp = datetime.strptime(start, "%Y%m%d").timestamp()
+        to_as_timestamp = datetime.strptime(end, "%Y%m%d").timestamp()
+        durations = sorted(set(int(duration) for duration in durations.split(",")))
+        min_size = int(min_size) if min_size != None else None
+    except ValueError:
+        return Response('{"result": false, "error": 2, "description": "From and to have to be dates (Ymd), durations a comma separated list of numbers and min_size a number."}', status=400, mimetype="application/json")
+
+    if to_as_timestamp <= from_as_timestamp or to_as_timestamp - from_as_timestamp > FLEXIBLE_MAX_DAYS * DAY or durations[0] < 1 or len(durations) > FLEXIBLE_MAX_DURATIONS:
+        return Response('{"result": false, "error": 2, "description": "Cannot proceed because the range has to end after it starts and span at most ' + str(FLEXIBLE_MAX_DAYS) + ' days, with at most ' + str(FLEXIBLE_MAX_DURATIONS) + ' durations of at least one day."}', status=400, mimetype="application/json")
+
+    logging.info(f"Searching for windows of {durations} days not reserved between {from_as_timestamp} and {to_as_timestamp}...")
+
+    if SEARCH_BACKEND == "memory":
+        with query_duration.labels("search_flexible_memory").time():
+            results = availability.free_windows(from_as_timestamp, to_as_timestamp, durations, min_size)
+    else:
+        # The reservations overlapping the range, sorted per apartment
+        with db_pool.connection() as db_connection, query_duration.labels("search_flexible_sqlite").time():
+            apartments = db_connection.execute("SELECT id, name, size FROM apartments WHERE ? IS NULL OR size >= ?", (min_size, min_size)).fetchall()
+            reservations = {}
+            for apartment, period_from, period_to in db_connection.execute("SELECT apartment, period_from, period_to FROM reservations WHERE period_from < ? AND period_to > ? ORDER BY apartment, period_from", (to_as_timestamp, from_as_timestamp)):
+                starts, ends = reservations.setdefault(apartment, ([], []))
+                starts.append(period_from)
+                ends.append(period_to)
+            results = [(name, size, free_windows(*reservations.get(id, ((), ())), from_as_timestamp, to_as_timestamp, durations)) for id, name, size in apartments]
+
+    rows = []
+    for name, size, windows in results:
+        if windows:
+            rows.append({"name": name, "size": size, "windows": [{"duration": duration, "first_start": as_date(first), "last_start": as_date(last)} for duration, first, last in windows]})
+    return Response(json.dumps({"apartments": rows}), status=200, mimetype="application/json")
+
+
+def as_date(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime("%Y%m%d")
+
+
+@app.route("/stats")
+def stats():
+    return Response(json.dumps({"db_pool": db_pool.stats(), "availability": availability.stats()}), status=200, mimetype="application/json")
+
+
+def apartment_or_reservations_changed(db_connection, method, properties, data):
+    # The in-memory model is only updated once the batch is committed.
+    # Apartments are identified by name and reservations by id, redelivered
+    # and stale events about them are skipped.
+    entity = data["name"] if method.exchange == "apartments" else data["id"]
+    if not claim_version(db_connection, method.exchange, entity, data.get("version"), deleted=method.routing_key == "deleted"):
+        logging.info(f"Skipping stale event {data.get('event_id')} about {method.exchange} {entity}.")
+        return
 
     if method.exchange == "apartments":
         if method.routing_key == "added":
             id = data["id"]
             name = data["name"]
+            size = data.get("size")
 
             logging.info(f"Adding apartment {name}...")
 
-            db_connection = sqlite3.connect("/home/data/search.db", isolation_level=None)
-            cursor = db_connection.cursor()
-            cursor.execute("INSERT INTO apartments VALUES (?, ?)", (id, name))
-            cursor.close()
-            db_connection.close()
+            db_connection.execute("INSERT INTO apartments (id, name, size) VALUES (?, ?, ?) ON CONFLICT (id) DO UPDATE SET name = excluded.name, size = excluded.size", (id, name, size))
+            return lambda: availability.add_apartment(id, name, size)
 
         if method.routing_key == "deleted":
             name = data["name"]
 
             logging.info(f"Deleting apartment {name}...")
 
-            db_connection = sqlite3.connect("/home/data/search.db", isolation_level=None)
-            cursor = db_connection.cursor()
-            cursor.execute("DELETE FROM apartments WHERE name = ?", (name,))
-            cursor.close()
-            db_connection.close()
+            db_connection.execute("DELETE FROM apartments WHERE name = ?", (name,))
+            return lambda: availability.remove_apartment(name)
 
     if method.exchange == "reservations":
         if method.routing_key == "added":
@@ -88,102 +183,253 @@ def apartment_or_reservations_changed(ch, method, properties, body):
 
             logging.info(f"Adding reservation {id}...")
 
-            db_connection = sqlite3.connect("/home/data/search.db", isolation_level=None)
-            cursor = db_connection.cursor()
-            cursor.execute("INSERT INTO reservations (id, apartment, period_from, period_to) VALUES (?, ?, ?, ?)", (id, apartment, period_from, period_to))
-            cursor.close()
-            db_connection.close()
+            previous = db_connection.execute("SELECT apartment, period_from FROM reservations WHERE id = ?", (id,)).fetchone()
+            db_connection.execute("INSERT INTO reservations (id, apartment, period_from, period_to) VALUES (?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET apartment = excluded.apartment, period_from = excluded.period_from, period_to = excluded.period_to", (id, apartment, period_from, period_to))
+            if previous != None and previous != (apartment, period_from):
+                update_max_ends(db_connection, *previous)
+            update_max_ends(db_connection, apartment, period_from)
+            return lambda: availability.add_reservation(id, apartment, period_from, period_to)
 
         if method.routing_key == "deleted":
             id = data["id"]
 
             logging.info(f"Deleting reservation {id}...")
 
-            db_connection = sqlite3.connect("/home/data/search.db", isolation_level=None)
-            cursor = db_connection.cursor()
-            cursor.execute("DELETE FROM reservations WHERE id = ?", (id,))
-            cursor.close()
-            db_connection.close()
+            previous = db_connection.execute("SELECT apartment, period_from FROM reservations WHERE id = ?", (id,)).fetchone()
+            db_connection.execute("DELETE FROM reservations WHERE id = ?", (id,))
+            if previous != None:
+                update_max_ends(db_connection, *previous)
+            return lambda: availability.remove_reservation(id)
 
 
-def connect_to_mq():
-    while True:
-        time.sleep(10)
-
-        try:
-            return pika.BlockingConnection(pika.ConnectionParameters(host="rabbitmq"))
-        except Exception as e:
-            logging.warning(f"Could not start listening to the message queue, retrying...")
+@app.route("/applied")
+def applied():
+    # Applied includes the in-memory model, its update is part of the step
+    # the projection lock covers
+    return applied_response(db_pool, request.args, lock=projection_lock)
 
 
-def listen_to_events(channel):
-    channel.start_consuming()
+@app.route("/metrics")
+def metrics():
+    return Response(render_metrics(), status=200, content_type="text/plain; version=0.0.4; charset=utf-8")
 
 
+@app.route("/health")
+def health():
+    # Any worker can answer this, the worker running the consumer records
+    # if it stopped for good
+    if has_failed("search"):
+        return Response('{"status": "consumer stopped"}', status=503, mimetype="application/json")
+    return Response('{"status": "ok"}', status=200, mimetype="application/json")
 
-if __name__ == "__main__":
-    logging.basicConfig(format="%(message)s", level=1 * 10)
-    logging.getLogger("pika").setLevel(logging.WARNING)
-    logging.getLogger("sqlite3").setLevel(logging.WARNING)
 
-    mq_connection = connect_to_mq()
+@app.route("/ready")
+def ready():
+    # Whether the replica can answer searches, the gateway only sends them
+    # to ready replicas. Any worker can answer this.
+    if is_ready("search"):
+        return Response('{"status": "ready"}', status=200, mimetype="application/json")
+    return Response('{"status": "catching up"}', status=503, mimetype="application/json")
 
-    channel = mq_connection.channel()
-    channel.exchange_declare(exchange="apartments", exchange_type="direct")
-    channel.exchange_declare(exchange="reservations", exchange_type="direct")
-    result = channel.queue_declare(queue="", exclusive=True)
-    queue_name = result.method.queue
-    channel.queue_bind(exchange="apartments", queue=queue_name, routing_key="added")
-    channel.queue_bind(exchange="apartments", queue=queue_name, routing_key="deleted")
-    channel.queue_bind(exchange="reservations", queue=queue_name, routing_key="added")
-    channel.queue_bind(exchange="reservations", queue=queue_name, routing_key="deleted")
-    channel.basic_consume(queue=queue_name, on_message_callback=apartment_or_reservations_changed, auto_ack=True)
 
-    logging.info("Waiting for messages.")
+def connect_to_mq():
+    while True:
+        time.sleep(10)
 
-    thread = threading.Thread(target=listen_to_events, args=(channel,), daemon=True)
-    thread.start()
+        try:
+            return pika.BlockingConnection(pika.ConnectionParameters(host="rabbitmq"))
+        except Exception as e:
+            logging.warning(f"Could not start listening to the message queue, retrying...")
 
-    # Verify if database has to be initialized
-    database_is_initialized = False
-    if os.path.exists("/home/data/search.db"):
-        database_is_initialized = True
-    else:
-        db_connection = sqlite3.connect("/home/data/search.db", isolation_level=None)
-        cursor = db_connection.cursor()
-        cursor.execute("CREATE TABLE IF NOT EXISTS apartments (id text, name text)")
-        cursor.execute("CREATE TABLE IF NOT EXISTS reservations (id text, apartment text, period_from integer, period_to integer)")
 
+def listen_to_events(mq_connection, channel, queue_name):
+    # Holding the projection lock keeps the database and the in-memory model
+    # in step with each other while the model is (re)loaded. Applied batches
+    # are announced on search_applied, the gateway evicts cached searches then.
+    #
+    # The replica is not ready while the broker is away, it misses the events
+    # published meanwhile, and becomes ready again once it caught up.
+    def consume(channel):
+        consume_in_batches(channel, queue_name, db_pool, apartment_or_reservations_changed, lock=projection_lock, ready=bootstrapped, stopping=stopping, caught_up=caught_up, applied_exchange="search_applied")
+
+    try:
+        consume_with_reconnects(mq_connection, channel, queue_name, BINDINGS, connect_to_mq, consume, stopping, lost=lost_events, recreated=lambda: bootstrap(True))
+    finally:
+        if not stopping.is_set():
+            logging.error("The event consumer stopped, the replica is unhealthy.")
+            mark_ready("search", False)
+            mark_failed("search", True)
+
+
+def lost_events():
+    mark_ready("search", False)
+    caught_up.clear()
+    threading.Thread(target=report_ready, daemon=True).start()
+
+
+# Schema versions, applied in order at startup to new and existing files
+MIGRATIONS = [
+    [
+        "CREATE TABLE IF NOT EXISTS apartments (id text, name text)",
+        "CREATE TABLE IF NOT EXISTS reservations (id text, apartment text, period_from integer, period_to integer)",
+        "CREATE INDEX IF NOT EXISTS reservations_availability ON reservations (apartment, period_from, period_to)",
+    ],
+    # Keys: the ids are primary keys and apartments are deleted by name.
+    # Rebuilding a table drops its indexes, they are created again.
+    [
+        lambda db_connection: rebuild_table(db_connection, "apartments", "id text PRIMARY KEY, name text NOT NULL", "id, name"),
+        "CREATE INDEX apartments_name ON apartments (name)",
+        lambda db_connection: rebuild_table(db_connection, "reservations", "id text PRIMARY KEY, apartment text NOT NULL, period_from integer NOT NULL, period_to integer NOT NULL", "id, apartment, period_from, period_to"),
+        "CREATE INDEX reservations_availability ON reservations (apartment, period_from, period_to)",
+    ],
+    # Sizes for the flexible search, unknown for the apartments added before
+    ["ALTER TABLE apartments ADD COLUMN size integer"],
+    # The latest end up to each reservation, so that the search is a single
+    # seek per apartment even if legacy reservations overlap (see
+    # common/periods.py)
+    [
+        "ALTER TABLE reservations ADD COLUMN max_end integer",
+        update_all_max_ends,
+        "DROP INDEX reservations_availability",
+        "CREATE INDEX reservations_availability ON reservations (apartment, period_from, max_end, period_to)",
+    ],
+]
+
+# Hot queries whose plans are compared when migrating
+QUERY_PLANS = {
+    "search_overlap": ("SELECT name FROM apartments WHERE NOT IFNULL((SELECT max_end FROM reservations WHERE apartment = apartments.id AND period_from < ? ORDER BY period_from DESC, max_end DESC LIMIT 1) > ?, 0)", (None, None)),
+    "apartment_delete": ("DELETE FROM apartments WHERE name = ?", (None,)),
+    "reservation_delete": ("DELETE FROM reservations WHERE id = ?", (None,)),
+}
+
+
+def setup_database():
+    with db_pool.connection() as db_connection:
+        migrate(db_connection, MIGRATIONS, QUERY_PLANS)
+        setup_offsets(db_connection)
+        setup_versions(db_connection)
+
+
+def load_apartments_from_db():
+    with db_pool.connection() as db_connection:
         while True:
             try:
-                data = requests.get(f"http://apartments:5000/apartments").json()
-                for entry in data["apartments"]:
-                    cursor.execute("INSERT INTO apartments VALUES (?, ?)", (entry["id"], entry["name"]))
+                db_connection.execute("BEGIN IMMEDIATE")
+                db_connection.execute("DELETE FROM apartments")
+                count, offset = load_snapshot(db_connection, "http://apartments:5000/snapshot", "apartments", "INSERT INTO apartments (id, name, size) VALUES (?, ?, ?)", lambda entry: (entry["id"], entry["name"], entry.get("size")))
+                db_connection.execute("COMMIT")
+                logging.info(f"Loaded {count} apartments up to event {offset}.")
                 break
             except Exception as e:
+                if db_connection.in_transaction:
+                    db_connection.execute("ROLLBACK")
                 print(e)
                 logging.warning("Apartments is down, reconnecting...")
                 time.sleep(5)
-            
+
+
+def load_reservations_from_db():
+    with db_pool.connection() as db_connection:
         while True:
             try:
-                data = requests.get(f"http://reserve:5000/reservations").json()
-                for entry in data["reservations"]:
-                    cursor.execute("INSERT INTO reservations (id, apartment, period_from, period_to) VALUES (?, ?, ?, ?)", (entry["id"], entry["apartment"], entry["period_from"], entry["period_to"]))
+                db_connection.execute("BEGIN IMMEDIATE")
+                db_connection.execute("DELETE FROM reservations")
+                count, offset = load_snapshot(db_connection, "http://reserve:5000/snapshot", "reservations", "INSERT INTO reservations (id, apartment, period_from, period_to) VALUES (?, ?, ?, ?)", lambda entry: (entry["id"], entry["apartment"], entry["period_from"], entry["period_to"]))
+                update_all_max_ends(db_connection)
+                db_connection.execute("COMMIT")
+                logging.info(f"Loaded {count} reservations up to event {offset}.")
                 break
             except:
+                if db_connection.in_transaction:
+                    db_connection.execute("ROLLBACK")
                 logging.warning("Reservations are down, reconnecting...")
                 time.sleep(5)
 
-        cursor.close()
-        db_connection.close()
-        database_is_initialized = True
 
-    if not database_is_initialized:
-        logging.error("Cannot initialize database.")
-    else:
+def replay(url, exchange):
+    # True if the missed events were replayed, False if the outbox of the
+    # producer no longer holds all of them
+    while True:
         try:
-            logging.info("Start.")
-            app.run(host="0.0.0.0", threaded=True)
-        finally:
-            mq_connection.close()
+            return replay_events(db_pool, url, exchange, apartment_or_reservations_changed, lock=projection_lock) != None
+        except requests.RequestException:
+            logging.warning(f"Could not replay the {exchange} events, reconnecting...")
+            time.sleep(5)
+
+
+def load_availability_from_db():
+    # The database is only the durable snapshot of the read model, searches
+    # are answered from memory
+    with projection_lock, db_pool.connection() as db_connection:
+        apartments = db_connection.execute("SELECT id, name, size FROM apartments").fetchall()
+        reservations = db_connection.execute("SELECT id, apartment, period_from, period_to FROM reservations ORDER BY apartment, period_from").fetchall()
+        availability.load(apartments, reservations)
+    logging.info(f"Loaded {len(apartments)} apartments and {len(reservations)} reservations into memory.")
+
+
+def initialize():
+    mark_ready("search", False)
+    mark_failed("search", False)
+    setup_database()
+
+    mq_connection = connect_to_mq()
+    queue_name = QUEUE_NAME or replica_queue_name(db_pool, "search")
+    channel, queue_created = declare_queue(mq_connection, queue_name, BINDINGS)
+
+    logging.info("Waiting for messages.")
+
+    # Events are only applied once the read model caught up, the ones that
+    # are already part of it are skipped
+    global consumer_thread
+    consumer_thread = threading.Thread(target=listen_to_events, args=(mq_connection, channel, queue_name), daemon=True)
+    consumer_thread.start()
+
+    bootstrap(queue_created)
+    bootstrapped.set()
+
+    # Ready once the events queued during the bootstrap are applied as well
+    threading.Thread(target=report_ready, daemon=True).start()
+
+
+def bootstrap(queue_created):
+    # A new database is loaded from snapshots. An existing one only missed
+    # events if the queue had to be created anew, these are replayed from
+    # the outboxes of the producers, or loaded from a snapshot if an outbox
+    # was pruned already.
+    offsets = read_offsets(db_pool)
+    if "apartments" not in offsets or (queue_created and not replay("http://apartments:5000/events", "apartments")):
+        load_apartments_from_db()
+    if "reservations" not in offsets or (queue_created and not replay("http://reserve:5000/events", "reservations")):
+        load_reservations_from_db()
+
+    load_availability_from_db()
+
+
+def report_ready():
+    caught_up.wait()
+    mark_ready("search", True)
+    logging.info("Caught up with the events, ready to search.")
+
+
+def start_background_tasks():
+    threading.Thread(target=initialize, daemon=True).start()
+
+
+def stop_background_tasks():
+    stopping.set()
+    if consumer_thread is not None:
+        mark_ready("search", False)
+        consumer_thread.join(timeout=10)
+    db_pool.close()
+    shutdown_tracing()
+
+
+if __name__ == "__main__":
+    configure_logging()
+
+    initialize()
+    try:
+        logging.info("Start.")
+        app.run(host="0.0.0.0", threaded=True)
+    finally:
+        stop_background_tasks()
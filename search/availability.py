@@ -0,0 +1,170 @@
+import math
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+DAY = 24 * 60 * 60
+
+
+class AvailabilityIndex:
+    # In-memory read model of the search service. For every apartment the
+    # reservations are kept as parallel columns sorted by start: the start
+    # and end timestamps plus the latest end up to each position, so checking
+    # an apartment is a single binary search even if reservations overlap.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._apartments = {}
+        self._sizes = {}
+        self._ids_by_name = {}
+        self._starts = {}
+        self._ends = {}
+        self._max_ends = {}
+        self._reservations = {}
+
+    def load(self, apartments, reservations):
+        with self._lock:
+            self._apartments.clear()
+            self._sizes.clear()
+            self._ids_by_name.clear()
+            self._starts.clear()
+            self._ends.clear()
+            self._max_ends.clear()
+            self._reservations.clear()
+
+            for id, name, size in apartments:
+                self._add_apartment(id, name, size)
+            for id, apartment, period_from, period_to in reservations:
+                self._add_reservation(id, apartment, period_from, period_to)
+
+    def add_apartment(self, id, name, size=None):
+        with self._lock:
+            self._add_apartment(id, name, size)
+
+    def _add_apartment(self, id, name, size):
+        self._apartments[id] = name
+        self._sizes[id] = size
+        self._ids_by_name[name] = id
+
+    def remove_apartment(self, name):
+        with self._lock:
+            id = self._ids_by_name.pop(name, None)
+            if id is not None:
+                self._apartments.pop(id, None)
+                self._sizes.pop(id, None)
+
+    def add_reservation(self, id, apartment, period_from, period_to):
+        with self._lock:
+            self._add_reservation(id, apartment, period_from, period_to)
+
+    def _add_reservation(self, id, apartment, period_from, period_to):
+        if id in self._reservations:
+            self._remove_reservation(id)
+
+        starts = self._starts.setdefault(apartment, array("d"))
+        ends = self._ends.setdefault(apartment, array("d"))
+        max_ends = self._max_ends.setdefault(apartment, array("d"))
+        position = bisect_right(starts, period_from)
+        starts.insert(position, period_from)
+        ends.insert(position, period_to)
+        max_ends.insert(position, period_to)
+        self._update_max_ends(apartment, position)
+        self._reservations[id] = (apartment, float(period_from), float(period_to))
+
+    def remove_reservation(self, id):
+        with self._lock:
+            self._remove_reservation(id)
+
+    def _remove_reservation(self, id):
+        entry = self._reservations.pop(id, None)
+        if entry is None:
+            return
+
+        apartment, period_from, period_to = entry
+        starts = self._starts[apartment]
+        ends = self._ends[apartment]
+        max_ends = self._max_ends[apartment]
+        position = bisect_left(starts, period_from)
+        while position < len(starts) and starts[position] == period_from:
+            if ends[position] == period_to:
+                del starts[position]
+                del ends[position]
+                del max_ends[position]
+                self._update_max_ends(apartment, position)
+                return
+            position += 1
+
+    def _update_max_ends(self, apartment, position):
+        # Recomputes the latest ends from a changed position on, until they
+        # agree with the stored ones again. Reservations are mostly added at
+        # the end, so this rarely walks far.
+        ends = self._ends[apartment]
+        max_ends = self._max_ends[apartment]
+        latest = max_ends[position - 1] if position > 0 else -math.inf
+        for index in range(position, len(ends)):
+            latest = max(latest, ends[index])
+            if index > position and max_ends[index] == latest:
+                break
+            max_ends[index] = latest
+
+    def free_apartments(self, period_from, period_to):
+        # Every reservation starting before the requested end collides if it
+        # ends after the requested start. Legacy reservations of one apartment
+        # may overlap, so the latest end of all of them is checked, not the end
+        # of the last one.
+        with self._lock:
+            names = []
+            for id, name in self._apartments.items():
+                starts = self._starts.get(id)
+                if starts:
+                    position = bisect_left(starts, period_to)
+                    if position > 0 and self._max_ends[id][position - 1] > period_from:
+                        continue
+                names.append(name)
+            return names
+
+    def free_windows(self, range_from, range_to, durations, min_size=None):
+        # (name, size, windows) of the apartments of at least min_size, see
+        # free_windows() below
+        with self._lock:
+            results = []
+            for id, name in self._apartments.items():
+                size = self._sizes.get(id)
+                if min_size is not None and (size is None or size < min_size):
+                    continue
+                results.append((name, size, free_windows(self._starts.get(id, ()), self._ends.get(id, ()), range_from, range_to, durations, self._max_ends.get(id))))
+            return results
+
+    def stats(self):
+        with self._lock:
+            return {"apartments": len(self._apartments), "reservations": len(self._reservations)}
+
+
+def free_windows(starts, ends, range_from, range_to, durations, max_ends=None):
+    # Sweeps once over the gaps the sorted reservations of one apartment
+    # leave within the range. A stay of d days fits a gap if it starts on a
+    # day of the range at or after the gap begins and ends by the time the
+    # gap ends. Returns (duration, first start, last start) for every gap
+    # and duration that fit, ordered by duration and start. max_ends are the
+    # latest ends up to each position if the caller keeps them.
+    windows = []
+    # Any reservation starting before the range may still be running, legacy
+    # ones may overlap so it is not necessarily the last of them
+    position = bisect_left(starts, range_from)
+    gap_from = range_from
+    if position > 0:
+        gap_from = max(gap_from, max_ends[position - 1] if max_ends is not None else max(ends[:position]))
+    while True:
+        running = position < len(starts) and starts[position] < range_to
+        gap_to = starts[position] if running else range_to
+        for duration in durations:
+            first = range_from + math.ceil((gap_from - range_from) / DAY) * DAY
+            last = range_from + math.floor((gap_to - duration * DAY - range_from) / DAY) * DAY
+            if first <= last:
+                windows.append((duration, first, last))
+        if not running:
+            break
+        gap_from = max(gap_from, ends[position])
+        position += 1
+    windows.sort()
+    return windows
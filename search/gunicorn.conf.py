@@ -0,0 +1,33 @@
+import os
+from common.serving import configure_logging, elect_background_worker, mark_ready
+
+wsgi_app = "app:app"
+bind = "0.0.0.0:5000"
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_WORKERS", "2"))
+threads = int(os.environ.get("WEB_THREADS", "8"))
+graceful_timeout = int(os.environ.get("WEB_GRACEFUL_TIMEOUT", "30"))
+
+# The in-memory model lives in the process running the event consumer, the
+# other workers would answer from an empty one
+if os.environ.get("SEARCH_BACKEND", "memory") == "memory":
+    workers = 1
+
+
+def on_starting(server):
+    # A restarted container is not ready until it caught up again
+    mark_ready("search", False)
+
+
+def post_worker_init(worker):
+    import app
+    configure_logging()
+
+    # The event consumer has to run exactly once per container
+    if elect_background_worker("search"):
+        app.start_background_tasks()
+
+
+def worker_exit(server, worker):
+    import app
+    app.stop_background_tasks()
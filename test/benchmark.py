@@ -0,0 +1,249 @@
+import argparse
+import json
+import random
+import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+import requests
+
+# Load generator for the whole system, driven through the gateway of a local
+# docker compose stack. Every route is requested at its own target rate (open
+# loop), latencies are measured from the moment a request was due, so a slow
+# system cannot hide its queueing delay by slowing the generator down.
+#
+#   python benchmark.py --duration 60 --rate search=50 --rate reserve_add=10 --output results.json
+
+DEFAULT_RATES = {
+    "apartments_add": 2,
+    "reserve_add": 10,
+    "reserve_delete": 5,
+    "search": 50,
+}
+
+
+class Workload:
+    # Shared state of the generated traffic: the apartments that can be
+    # reserved and the reservations that can be deleted
+
+    def __init__(self, gateway, session, seed):
+        self.gateway = gateway
+        self.session = session
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.apartments = []
+        self.reservations = []
+
+    def random_date(self):
+        with self.lock:
+            day = date(2001, 1, 1) + timedelta(days=self.random.randrange(3 * 365))
+        return day.strftime("%Y%m%d")
+
+    def apartments_add(self):
+        name = f"bench-{uuid.uuid4()}"
+        response = self.session.get(f"{self.gateway}/apartments/add", params={"name": name, "size": 50})
+        if response.status_code == 201:
+            with self.lock:
+                self.apartments.append(name)
+        return response
+
+    def reserve_add(self):
+        with self.lock:
+            name = self.random.choice(self.apartments) if self.apartments else "bench-missing"
+            duration = self.random.randint(1, 14)
+        params = {"name": name, "start": self.random_date(), "duration": duration, "vip": 0}
+        response = self.session.get(f"{self.gateway}/reserve/add", params=params)
+        if response.status_code == 201:
+            with self.lock:
+                self.reservations.append(response.json()["id"])
+        return response
+
+    def reserve_delete(self):
+        with self.lock:
+            id = self.reservations.pop(self.random.randrange(len(self.reservations))) if self.reservations else -1
+        return self.session.get(f"{self.gateway}/reserve/delete", params={"id": id})
+
+    def search(self):
+        with self.lock:
+            duration = self.random.randint(1, 14)
+        return self.session.get(f"{self.gateway}/search", params={"date": self.random_date(), "duration": duration})
+
+
+class RouteStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.late = 0
+
+    def record(self, latency, status):
+        with self.lock:
+            self.latencies.append(latency)
+            if status is None:
+                self.errors += 1
+            else:
+                self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+
+    def summary(self, elapsed):
+        with self.lock:
+            latencies = sorted(self.latencies)
+        return {
+            "requests": len(latencies),
+            "throughput": round(len(latencies) / elapsed, 2) if elapsed else 0,
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "max_ms": round(latencies[-1] * 1000, 2) if latencies else None,
+            "statuses": self.statuses,
+            "errors": self.errors,
+            "late": self.late,
+        }
+
+
+def percentile(sorted_values, p):
+    # Nearest rank
+    if not sorted_values:
+        return None
+    rank = max(int(round(p / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return round(sorted_values[min(rank, len(sorted_values) - 1)] * 1000, 2)
+
+
+def timed_request(operation, due, stats):
+    try:
+        status = operation().status_code
+    except requests.RequestException:
+        status = None
+    stats.record(time.perf_counter() - due, status)
+
+
+def generate(route, rate, operation, stats, executor, started, deadline):
+    # Schedules the requests of one route at fixed intervals. If the
+    # generator falls behind, it catches up instead of skipping requests.
+    interval = 1 / rate
+    due = started
+    while due < deadline:
+        now = time.perf_counter()
+        if due > now:
+            time.sleep(due - now)
+        elif now - due > interval:
+            stats.late += 1
+        executor.submit(timed_request, operation, due, stats)
+        due += interval
+
+
+def seed(workload, apartments):
+    names = [f"bench-{uuid.uuid4()}" for _ in range(apartments)]
+    response = workload.session.post(f"{workload.gateway}/apartments/add_batch", data=json.dumps([{"name": name, "size": 50} for name in names]), headers={"Content-Type": "application/json"})
+    if response.status_code in (201, 207):
+        workload.apartments.extend(name for name, item in zip(names, response.json()["items"]) if item["result"])
+    if len(workload.apartments) < apartments:
+        raise SystemExit(f"Only {len(workload.apartments)} of {apartments} apartments could be added, is the stack running?")
+    return max(item["sequence"] for item in response.json()["items"] if item["result"])
+
+
+def wait_until_seeded(workload, sequence, reserve):
+    # Reservations and searches need the apartments in the read models of
+    # reserve and of every search replica, the batch is applied once its
+    # last event is
+    params = {"exchange": "apartments", "sequence": sequence, "timeout": 30}
+    for url in (f"{workload.gateway}/replicas/applied", f"{reserve}/applied"):
+        response = workload.session.get(url, params=params)
+        if response.status_code != 200:
+            raise SystemExit(f"The apartments were not applied by {url} in time ({response.status_code}).")
+
+
+def clean_up(workload):
+    for id in workload.reservations:
+        workload.session.get(f"{workload.gateway}/reserve/delete", params={"id": id})
+    for name in workload.apartments:
+        workload.session.get(f"{workload.gateway}/apartments/delete", params={"name": name})
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_rates(values):
+    rates = dict(DEFAULT_RATES)
+    for value in values or []:
+        route, _, rate = value.partition("=")
+        if route not in DEFAULT_RATES:
+            raise SystemExit(f"Unknown route {route}, choose from {', '.join(DEFAULT_RATES)}.")
+        rates[route] = float(rate)
+    return {route: rate for route, rate in rates.items() if rate > 0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive a mix of traffic against the gateway and report throughput and latency per route.")
+    parser.add_argument("--gateway", default="http://localhost:5050")
+    parser.add_argument("--reserve", default="http://localhost:5003", help="reserve service, asked whether it applied the seeded apartments")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of measured load")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds of load before measuring")
+    parser.add_argument("--rate", action="append", metavar="ROUTE=PER_SECOND", help=f"target rate of a route, 0 disables it (defaults: {DEFAULT_RATES})")
+    parser.add_argument("--apartments", type=int, default=50, help="apartments added before the run")
+    parser.add_argument("--concurrency", type=int, default=64, help="maximum requests in flight")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--label", default=None, help="free text stored with the results")
+    parser.add_argument("--output", default=None, help="file the JSON results are written to")
+    parser.add_argument("--keep", action="store_true", help="keep the generated apartments and reservations")
+    args = parser.parse_args()
+
+    rates = parse_rates(args.rate)
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=args.concurrency))
+    workload = Workload(args.gateway.rstrip("/"), session, args.seed)
+
+    sequence = seed(workload, args.apartments)
+    wait_until_seeded(workload, sequence, args.reserve.rstrip("/"))
+
+    results = {}
+    try:
+        for phase, duration in (("warmup", args.warmup), ("measured", args.duration)):
+            if duration <= 0:
+                continue
+            stats = {route: RouteStats() for route in rates}
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                started = time.perf_counter()
+                deadline = started + duration
+                generators = [threading.Thread(target=generate, args=(route, rate, getattr(workload, route), stats[route], executor, started, deadline)) for route, rate in rates.items()]
+                for generator in generators:
+                    generator.start()
+                for generator in generators:
+                    generator.join()
+            # Includes the time needed to drain the requests still in flight
+            elapsed = time.perf_counter() - started
+            if phase == "measured":
+                results = {route: stats[route].summary(elapsed) for route in rates}
+    finally:
+        if not args.keep:
+            clean_up(workload)
+
+    report = {
+        "label": args.label,
+        "commit": git_commit(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "gateway": args.gateway,
+        "duration": args.duration,
+        "rates": rates,
+        "concurrency": args.concurrency,
+        "routes": results,
+    }
+
+    print(f"{'route':<16}{'target/s':>10}{'actual/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}  statuses")
+    for route, summary in results.items():
+        print(f"{route:<16}{rates[route]:>10g}{summary['throughput']:>10}{summary['p50_ms']!s:>10}{summary['p95_ms']!s:>10}{summary['p99_ms']!s:>10}{summary['errors']:>8}  {summary['statuses']}")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
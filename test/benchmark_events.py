@@ -0,0 +1,73 @@
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.encoding import CONTENT_TYPES, encode_event, decode_event
+
+# Cost of encoding and decoding events and their size on the wire, for each
+# event format, measured in process on events shaped like the ones the
+# services publish. Properties (content type, schema version) are included
+# in the timings since they are created for every event.
+#
+#   python benchmark_events.py --events 100000 --output events.json
+
+
+def sample_events(count):
+    # The mix of the load benchmark: mostly reservations, some apartments
+    events = []
+    for sequence in range(1, count + 1):
+        if sequence % 10 == 0:
+            data = {"id": str(uuid.uuid4()), "name": f"bench-{uuid.uuid4()}"}
+        else:
+            data = {"id": str(uuid.uuid4()), "apartment": str(uuid.uuid4()), "from": 978307200.0 + sequence * 86400, "to": 978307200.0 + (sequence + 7) * 86400}
+        data.update({"event_id": str(uuid.uuid4()), "version": sequence, "sequence": sequence, "timestamp": time.time()})
+        events.append(data)
+    return events
+
+
+def measure(format, events):
+    started = time.perf_counter()
+    encoded = [encode_event(data, format) for data in events]
+    encoding = time.perf_counter() - started
+
+    started = time.perf_counter()
+    decoded = [decode_event(body, properties) for body, properties in encoded]
+    decoding = time.perf_counter() - started
+
+    assert decoded == events
+    size = sum(len(body) for body, _ in encoded)
+    return {
+        "events": len(events),
+        "encode_us_per_event": round(encoding / len(events) * 1000000, 2),
+        "decode_us_per_event": round(decoding / len(events) * 1000000, 2),
+        "bytes_per_event": round(size / len(events), 1),
+        "total_bytes": size,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the event formats by encode/decode cost and size.")
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--output", default=None, help="file the JSON results are written to")
+    args = parser.parse_args()
+
+    events = sample_events(args.events)
+    for format in CONTENT_TYPES:
+        measure(format, events[:1000])
+    results = {format: measure(format, events) for format in CONTENT_TYPES}
+
+    print(f"{'format':<10}{'encode us':>12}{'decode us':>12}{'bytes/event':>13}{'total bytes':>14}")
+    for format, result in results.items():
+        print(f"{format:<10}{result['encode_us_per_event']:>12}{result['decode_us_per_event']:>12}{result['bytes_per_event']:>13}{result['total_bytes']:>14}")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import json
+import os
+import sys
+import time
+from flask import Flask, Response
+from opentelemetry.instrumentation.flask import FlaskInstrumentor
+from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.tracing import create_sampler, create_tracer_provider
+
+# Per-request overhead of tracing, measured in process on a Flask route
+# instrumented like the services, once without tracing and once for each
+# sampling configuration. Spans are handed to a discarding exporter unless
+# --otlp is given, so the numbers do not depend on the collector.
+#
+#   python benchmark_tracing.py --requests 20000 --output tracing.json
+
+CONFIGURATIONS = {
+    "off": None,
+    "always_on": dict(sampler="always_on"),
+    "ratio_10_percent": dict(sampler="ratio", ratio=0.1),
+    "rate_limited_10_per_second": dict(sampler="rate_limited", rate=10),
+    "ratio_1_percent_keep_errors_and_slow": dict(sampler="ratio", ratio=0.01, keep_errors=True, slow_threshold_ms=100),
+}
+
+
+class DiscardingExporter(SpanExporter):
+
+    def __init__(self):
+        self.exported = 0
+
+    def export(self, spans):
+        self.exported += len(spans)
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self):
+        pass
+
+
+def create_app():
+    app = Flask(__name__)
+
+    @app.route("/search")
+    def search():
+        return Response('{"apartments": []}', status=200, mimetype="application/json")
+
+    return app
+
+
+def measure(configuration, requests, otlp):
+    app = create_app()
+    provider = None
+    exporter = None
+    if configuration is not None:
+        keep_errors = configuration.get("keep_errors", False)
+        slow_threshold_ms = configuration.get("slow_threshold_ms", 0)
+        sampler = create_sampler(configuration["sampler"], configuration.get("ratio", 0), configuration.get("rate", 0), keep_errors or slow_threshold_ms > 0)
+        exporter = None if otlp else DiscardingExporter()
+        provider = create_tracer_provider(exporter, sampler, keep_errors, slow_threshold_ms)
+        FlaskInstrumentor().instrument_app(app, tracer_provider=provider)
+
+    client = app.test_client()
+    for _ in range(min(requests, 1000)):
+        client.get("/search?date=20010101&duration=10")
+
+    started = time.perf_counter()
+    for _ in range(requests):
+        client.get("/search?date=20010101&duration=10")
+    elapsed = time.perf_counter() - started
+
+    if provider is not None:
+        provider.shutdown()
+    return {
+        "requests": requests,
+        "us_per_request": round(elapsed / requests * 1000000, 1),
+        "exported_spans": exporter.exported if exporter is not None else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the per-request overhead of tracing.")
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--otlp", action="store_true", help="export to the OTLP endpoint configured in the environment")
+    parser.add_argument("--output", default=None, help="file the JSON results are written to")
+    args = parser.parse_args()
+
+    results = {name: measure(configuration, args.requests, args.otlp) for name, configuration in CONFIGURATIONS.items()}
+    baseline = results["off"]["us_per_request"]
+    for result in results.values():
+        result["overhead_us"] = round(result["us_per_request"] - baseline, 1)
+
+    print(f"{'configuration':<40}{'us/request':>12}{'overhead us':>13}{'exported':>10}")
+    for name, result in results.items():
+        print(f"{name:<40}{result['us_per_request']:>12}{result['overhead_us']:>13}{result['exported_spans']!s:>10}")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
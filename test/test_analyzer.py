@@ -0,0 +1,115 @@
+import io
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "analyzer"))
+import analyzer
+
+# Runs offline against small exports, unlike the tests of the running system
+
+
+def jaeger_span(trace_id, span_id, parent, process, kind, url=None):
+    tags = [{"key": "span.kind", "type": "string", "value": kind}]
+    if url is not None:
+        tags.append({"key": "http.url", "type": "string", "value": url})
+    references = [{"refType": "CHILD_OF", "traceID": trace_id, "spanID": parent}] if parent else []
+    return {"traceID": trace_id, "spanID": span_id, "references": references, "duration": 1500, "processID": process, "tags": tags}
+
+
+def jaeger_export():
+    processes = {"p1": {"serviceName": "gateway"}, "p2": {"serviceName": "search"}}
+    return {"data": [
+        {
+            # A search answered from the replica
+            "traceID": "t1",
+            "spans": [
+                jaeger_span("t1", "a", None, "p1", "server"),
+                jaeger_span("t1", "b", "a", "p1", "client", "http://search:5000/search?date=20010101&duration=10"),
+                jaeger_span("t1", "c", "b", "p2", "server"),
+            ],
+            "processes": processes,
+        },
+        {
+            # A search asking the apartments service while answering
+            "traceID": "t2",
+            "spans": [
+                jaeger_span("t2", "a", None, "p1", "server"),
+                jaeger_span("t2", "b", "a", "p1", "client", "http://search:5000/search?date=20010101&duration=10"),
+                jaeger_span("t2", "c", "b", "p2", "server"),
+                jaeger_span("t2", "d", "c", "p2", "client", "http://apartments:5000/apartments"),
+            ],
+            "processes": processes,
+        },
+        {
+            # The snapshot bootstrap at startup is not part of a request
+            "traceID": "t3",
+            "spans": [jaeger_span("t3", "a", None, "p2", "client", "http://apartments:5000/snapshot")],
+            "processes": processes,
+        },
+    ]}
+
+
+def otlp_export():
+    def attribute(key, value):
+        return {"key": key, "value": {"stringValue": value}}
+
+    return {"resourceSpans": [{
+        "resource": {"attributes": [attribute("service.name", "reserve")]},
+        "scopeSpans": [{"spans": [
+            {"traceId": "t4", "spanId": "a", "kind": 2, "startTimeUnixNano": "1000000", "endTimeUnixNano": "5000000", "attributes": []},
+            {"traceId": "t4", "spanId": "b", "parentSpanId": "a", "kind": "SPAN_KIND_CLIENT", "startTimeUnixNano": "2000000", "endTimeUnixNano": "4000000", "attributes": [attribute("http.url", "http://apartments:5000/apartments")]},
+        ]}],
+    }]}
+
+
+def analyze(text, replicas=analyzer.DEFAULT_REPLICAS):
+    graph = analyzer.CallGraph(replicas)
+    for span in analyzer.read_spans(io.StringIO(text)):
+        graph.add(*span)
+    return graph.report()
+
+
+def test_jaeger_export():
+    report = analyze(json.dumps(jaeger_export()))
+    assert report["spans"] == 8
+    assert report["requests"] == {"gateway": 2, "search": 2}
+
+    violations = [(v["caller"], v["callee"], v["path"], v["on_request_path"]) for v in report["violations"]]
+    assert violations == [("search", "apartments", "/apartments", 1)], "Test if only the call made while answering a search is flagged"
+    assert report["violations"][0]["example_traces"] == ["t2"]
+
+    edges = {(e["caller"], e["callee"], e["path"]): e for e in report["edges"]}
+    assert edges[("gateway", "search", "/search")]["calls"] == 2, "Test if query strings are not part of the call graph"
+    assert edges[("search", "apartments", "/snapshot")]["on_request_path"] == 0
+
+
+def test_otlp_export():
+    report = analyze(json.dumps(otlp_export()))
+    assert [(v["caller"], v["callee"]) for v in report["violations"]] == [("reserve", "apartments")]
+    assert report["edges"][0]["mean_ms"] == 2.0
+
+
+def test_streamed_in_small_chunks(monkeypatch):
+    # Values spanning chunk boundaries, several documents one per line
+    monkeypatch.setattr(analyzer, "CHUNK_SIZE", 7)
+    text = json.dumps(jaeger_export(), indent=1) + "\n" + json.dumps(otlp_export()) + "\n"
+    report = analyze(text)
+    assert report["spans"] == 10
+    assert len(report["violations"]) == 2
+
+
+def test_replicas_can_be_configured():
+    report = analyze(json.dumps(jaeger_export()), replicas={"gateway": ["search"]})
+    assert [(v["caller"], v["callee"]) for v in report["violations"]] == [("gateway", "search")]
+
+
+def test_exit_status(tmp_path, capsys):
+    export = tmp_path / "traces.json"
+    export.write_text(json.dumps(jaeger_export()))
+    output = tmp_path / "report.json"
+    assert analyzer.main([str(export), "--json", str(output)]) == 1, "Test if violations fail the run"
+    assert "search -> apartments /apartments" in capsys.readouterr().out
+    assert json.loads(output.read_text())["violations"]
+
+    assert analyzer.main([str(export), "--replica", "search:reserve"]) == 0
@@ -0,0 +1,48 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from search.availability import AvailabilityIndex
+
+# Runs offline against the in-memory read model
+
+
+def test_overlapping_reservations():
+    index = AvailabilityIndex()
+    index.load([("1", "a", 10)], [("A", "1", 1, 10), ("B", "1", 2, 3)])
+    assert index.free_apartments(5, 6) == []
+    assert index.free_apartments(10, 11) == ["a"]
+
+    index.remove_reservation("A")
+    assert index.free_apartments(5, 6) == ["a"]
+    assert index.free_apartments(2, 3) == []
+
+
+def test_free_apartments_matches_every_reservation():
+    rng = random.Random(0)
+    index = AvailabilityIndex()
+    index.load([("1", "a", 10)], [])
+    reservations = {}
+    for step in range(500):
+        if reservations and rng.random() < 0.3:
+            id = rng.choice(sorted(reservations))
+            index.remove_reservation(id)
+            del reservations[id]
+        else:
+            period_from = rng.randrange(100)
+            period_to = period_from + rng.randrange(1, 20)
+            reservations[str(step)] = (period_from, period_to)
+            index.add_reservation(str(step), "1", period_from, period_to)
+
+        period_from = rng.randrange(100)
+        period_to = period_from + rng.randrange(1, 10)
+        taken = any(start < period_to and end > period_from for start, end in reservations.values())
+        assert index.free_apartments(period_from, period_to) == ([] if taken else ["a"])
+
+
+def test_free_windows_after_overlapping_reservations():
+    day = 24 * 60 * 60
+    index = AvailabilityIndex()
+    index.load([("1", "a", 10)], [("A", "1", 0, 10 * day), ("B", "1", 2 * day, 3 * day)])
+    assert index.free_windows(5 * day, 15 * day, [1], 10) == [("a", 10, [(1, 10 * day, 14 * day)])]
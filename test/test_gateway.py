@@ -1,11 +1,17 @@
 import requests
 import uuid
 import sqlite3
-import time
 import json
 import pytest
+import random
+from concurrent.futures import ThreadPoolExecutor
 
 data_folder = "..\\data"
+apartments_service = "http://localhost:5001"
+search_service = "http://localhost:5002"
+reserve_service = "http://localhost:5003"
+# The gateway asks every ready search replica at /replicas/applied
+search_replicas = "http://localhost:5050/replicas"
 
 def clean_up():
     r1 = requests.get(f"http://localhost:5050/apartments/apartments")
@@ -29,8 +35,8 @@ def test_apartment():
     assert r3.status_code == 201, "Test if new apartment can be added"
 
     assert apartment_exists_in_db("apartments", random_apartment_name), "Test if new apartment was added to the apartment db"
-    time.sleep(1)  # Give some time to services to receive update from message queue
-    assert apartment_exists_in_db("search", random_apartment_name), "Test if new apartment was added to the search db"
+    wait_until_applied([search_replicas, reserve_service], "apartments", r3)
+    assert apartment_is_free(random_apartment_name), "Test if new apartment was added to the search read model"
     assert apartment_exists_in_db("reservations", random_apartment_name), "Test if new apartment was added to the reservations db"
 
     r4 = requests.get(f"http://localhost:5050/apartments/add?name={random_apartment_name}&size=150")
@@ -43,8 +49,8 @@ def test_apartment():
     assert r6.status_code == 201, "Test if new apartment can be deleted"
 
     assert not apartment_exists_in_db("apartments", random_apartment_name), "Test if new apartment was deleted from the apartment db"
-    time.sleep(1)  # Give some time to services to receive update from message queue
-    assert not apartment_exists_in_db("search", random_apartment_name), "Test if new apartment was deleted from the search db"
+    wait_until_applied([search_replicas, reserve_service], "apartments", r6)
+    assert not apartment_is_free(random_apartment_name), "Test if new apartment was deleted from the search read model"
     assert not apartment_exists_in_db("reservations", random_apartment_name), "Test if new apartment was deleted from the search db"
 
 
@@ -53,8 +59,8 @@ def test_reservation():
 
     random_apartment_name = str(uuid.uuid4())
     
-    requests.get(f"http://localhost:5050/apartments/add?name={random_apartment_name}&size=100")
-    time.sleep(1)  # Give some time to services to receive update from message queue
+    r0 = requests.get(f"http://localhost:5050/apartments/add?name={random_apartment_name}&size=100")
+    wait_until_applied([search_replicas, reserve_service], "apartments", r0)
 
     r1 = requests.get(f"http://localhost:5050/reserve/add")
     assert r1.status_code == 400, "Test if status code 400 (Bad request) is returned if not enough data is provided"
@@ -67,8 +73,8 @@ def test_reservation():
     id = json.loads(r3.content)["id"]
 
     assert reservation_exists_in_db("reservations", id), "Test if new reservation was added to the reservations db"
-    time.sleep(1)  # Give some time to services to receive update from message queue
-    assert reservation_exists_in_db("search", id), "Test if new reservation was added to the search db"
+    wait_until_applied([search_replicas], "reservations", r3)
+    assert not apartment_is_free(random_apartment_name, "20010101", 10), "Test if new reservation was added to the search read model"
 
     r4 = requests.get(f"http://localhost:5050/reserve/add?name={random_apartment_name}&start=20010101&duration=10&vip=1")
     assert r4.status_code == 400, "Test if new reservation cannot be added another time and the response is status code 400 (Bad request)"
@@ -86,8 +92,34 @@ def test_reservation():
     assert r6.status_code == 201, "Test if new reservation can be deleted"
 
     assert not reservation_exists_in_db("reservations", id), "Test if new reservation was deleted from the reservations db"
-    time.sleep(1)  # Give some time to services to receive update from message queue
-    assert not reservation_exists_in_db("search", id), "Test if new reservation was deleted from the search db"
+    wait_until_applied([search_replicas], "reservations", r6)
+    assert apartment_is_free(random_apartment_name, "20010101", 10), "Test if new reservation was deleted from the search read model"
+
+def test_concurrent_reservations():
+    clean_up()
+
+    random_apartment_name = str(uuid.uuid4())
+    r0 = requests.get(f"http://localhost:5050/apartments/add?name={random_apartment_name}&size=100")
+    wait_until_applied([reserve_service], "apartments", r0)
+
+    # Many overlapping bookings of one apartment at the same time, within
+    # a month so that most of them collide
+    def book(start):
+        return requests.get(f"http://localhost:5050/reserve/add?name={random_apartment_name}&start=200101{start:02d}&duration=3&vip=0")
+
+    with ThreadPoolExecutor(max_workers=50) as executor:
+        responses = list(executor.map(book, [random.randint(1, 28) for _ in range(500)]))
+
+    assert all(r.status_code in (201, 400) for r in responses), "Test if every booking is either accepted or rejected"
+    accepted = set(json.loads(r.content)["id"] for r in responses if r.status_code == 201)
+    assert len(accepted) > 0
+
+    r1 = requests.get(f"http://localhost:5050/reserve/reservations")
+    periods = sorted((entry["period_from"], entry["period_to"]) for entry in json.loads(r1.content)["reservations"] if entry["id"] in accepted)
+    assert len(periods) == len(accepted), "Test if every accepted booking was stored"
+    for (_, previous_to), (next_from, _) in zip(periods, periods[1:]):
+        assert previous_to <= next_from, "Test if the apartment was never booked twice for the same days"
+
 
 def test_search():
     clean_up()
@@ -96,10 +128,10 @@ def test_search():
     random_apartment_name_1 = "Apartment1"
     random_apartment_name_2 = "Apartment2"
     requests.get(f"http://localhost:5050/apartments/add?name={random_apartment_name_1}&size=100")
-    requests.get(f"http://localhost:5050/apartments/add?name={random_apartment_name_2}&size=100")
-    time.sleep(1)  # Give some time to services to receive update from message queue
-    requests.get(f"http://localhost:5050/reserve/add?name={random_apartment_name_1}&start=20010101&duration=10&vip=1")
-    time.sleep(1)  # Give some time to services to receive update from message queue
+    r0 = requests.get(f"http://localhost:5050/apartments/add?name={random_apartment_name_2}&size=100")
+    wait_until_applied([search_replicas, reserve_service], "apartments", r0)
+    r0 = requests.get(f"http://localhost:5050/reserve/add?name={random_apartment_name_1}&start=20010101&duration=10&vip=1")
+    wait_until_applied([search_replicas], "reservations", r0)
 
     r1 = requests.get(f"http://localhost:5050/search")
     assert r1.status_code == 400, "Test if status code 400 (Bad request) is returned if not enough data is provided"
@@ -115,6 +147,111 @@ def test_search():
     assert random_apartment_name_2 in apartments
 
 
+def test_flexible_search():
+    clean_up()
+
+    requests.get(f"http://localhost:5050/apartments/add?name=Small&size=30")
+    r0 = requests.get(f"http://localhost:5050/apartments/add?name=Large&size=100")
+    wait_until_applied([search_replicas, reserve_service], "apartments", r0)
+    r0 = requests.get(f"http://localhost:5050/reserve/add?name=Large&start=20010305&duration=10&vip=0")
+    wait_until_applied([search_replicas], "reservations", r0)
+
+    r1 = requests.get(f"http://localhost:5050/search/flexible?from=20010301")
+    assert r1.status_code == 400, "Test if status code 400 (Bad request) is returned if not enough data is provided"
+
+    r2 = requests.get(f"http://localhost:5050/search/flexible?from=20010301&to=20010401&durations=3,7&min_size=50")
+    assert r2.status_code == 200, "Test flexible search"
+    apartments = json.loads(r2.content)["apartments"]
+    assert [apartment["name"] for apartment in apartments] == ["Large"], "Test if smaller apartments are filtered out"
+    assert apartments[0]["windows"] == [
+        {"duration": 3, "first_start": "20010301", "last_start": "20010302"},
+        {"duration": 3, "first_start": "20010315", "last_start": "20010329"},
+        {"duration": 7, "first_start": "20010315", "last_start": "20010325"},
+    ], "Test if the windows around the reservation are found"
+
+
+def test_batch():
+    clean_up()
+
+    apartments = [{"name": f"Batch{i}", "size": 50} for i in range(100)] + [{"name": "Batch0", "size": 50}, {"name": "BatchBroken", "size": "big"}]
+    r1 = requests.post(f"http://localhost:5050/apartments/add_batch", data=json.dumps(apartments), headers={"Content-Type": "application/json"})
+    assert r1.status_code == 207, "Test if status code 207 (Multi-Status) is returned if only some apartments can be added"
+    results = json.loads(r1.content)["items"]
+    assert [result["result"] for result in results] == [True] * 100 + [False, False], "Test if every apartment gets its own result"
+    wait_until_applied([search_replicas, reserve_service], "apartments", r1)
+
+    reservations = [{"name": "Batch1", "start": "20010101", "duration": 10, "vip": 0}, {"name": "Batch1", "start": "20010105", "duration": 2, "vip": 0}, {"name": "Batch2", "start": "20010105", "duration": 2, "vip": 1}]
+    r2 = requests.post(f"http://localhost:5050/reserve/add_batch", data="\n".join(map(json.dumps, reservations)), headers={"Content-Type": "application/x-ndjson"})
+    assert r2.status_code == 207, "Test if reservations can be added as NDJSON"
+    results = json.loads(r2.content)["items"]
+    assert [result["result"] for result in results] == [True, False, True], "Test if reservations of one batch conflicting with each other are rejected"
+    wait_until_applied([search_replicas], "reservations", r2)
+
+    r3 = requests.get(f"http://localhost:5050/search?date=20010106&duration=1")
+    apartments = list(map(lambda x: x["name"], json.loads(r3.content)["apartments"]))
+    assert "Batch1" not in apartments and "Batch2" not in apartments and "Batch3" in apartments
+
+    r4 = requests.post(f"http://localhost:5050/apartments/add_batch", data="not json")
+    assert r4.status_code == 400, "Test if status code 400 (Bad request) is returned if the body cannot be read"
+
+    r1 = requests.get(f"{search_service}/applied")
+    assert r1.status_code == 200, "Test if the offsets of the read model can be requested"
+    assert "applied" in json.loads(r1.content)
+
+    r2 = requests.get(f"{search_service}/applied?sequence=1")
+    assert r2.status_code == 400, "Test if status code 400 (Bad request) is returned if the exchange of the sequence is missing"
+
+    r3 = requests.get(f"{reserve_service}/applied?exchange=apartments&sequence=999999999&timeout=1")
+    assert r3.status_code == 504, "Test if status code 504 is returned if the event is not applied in time"
+
+
+def test_ready():
+    r1 = requests.get(f"{search_service}/ready")
+    assert r1.status_code == 200, "Test if search is ready once it caught up with the events"
+
+    r2 = requests.get(f"http://localhost:5050/replicas/stats")
+    assert r2.status_code == 200
+    assert len(json.loads(r2.content)["search"]["ready"]) >= 1, "Test if the gateway found the ready search replicas"
+
+
+def test_events():
+    random_apartment_name = str(uuid.uuid4())
+
+    r1 = requests.get(f"http://localhost:5050/apartments/add?name={random_apartment_name}&size=50")
+    assert r1.status_code == 201
+    sequence = json.loads(r1.content)["sequence"]
+
+    r2 = requests.get(f"{apartments_service}/events?after={sequence - 1}")
+    assert r2.status_code == 200
+    lines = [json.loads(line) for line in r2.content.splitlines() if line]
+    assert lines[0]["complete"], "Test if the outbox still holds the latest events for consumers to replay"
+    assert lines[1]["sequence"] == sequence and lines[1]["routing_key"] == "added", "Test if the events after the given sequence are replayed in order"
+
+    r3 = requests.get(f"{apartments_service}/events?after=latest")
+    assert r3.status_code == 400, "Test if status code 400 (Bad request) is returned if after is not a sequence number"
+
+    requests.get(f"http://localhost:5050/apartments/delete?name={random_apartment_name}")
+
+
+def wait_until_applied(services, exchange, response):
+    # Waits until the read models of the services applied the event published
+    # for the response instead of guessing how long that takes. Batches are
+    # applied once their last event is.
+    data = json.loads(response.content)
+    sequence = data["sequence"] if "sequence" in data else max(item["sequence"] for item in data["items"] if item["result"])
+    for service in services:
+        r = requests.get(f"{service}/applied", params={"exchange": exchange, "sequence": sequence, "timeout": 10})
+        assert r.status_code == 200, f"Test if {service} applied event {sequence} of {exchange} in time"
+
+
+def apartment_is_free(name, date="20010101", duration=1):
+    # The read models of search live in the volumes of the replicas, they
+    # are checked through the gateway once all replicas applied the events
+    r = requests.get(f"http://localhost:5050/search", params={"date": date, "duration": duration})
+    assert r.status_code == 200
+    return name in [entry["name"] for entry in json.loads(r.content)["apartments"]]
+
+
 def apartment_exists_in_db(db, name):
     print(f"Checking if {name} exists in apartments...")
     connection = sqlite3.connect(f"C:\\Users\\Alberto\\Desktop\\Thesis stuff\\cse-microservices4-fixed\\data\\{db}.db", isolation_level=None)
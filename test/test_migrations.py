@@ -0,0 +1,61 @@
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.migrations import migrate, rebuild_table
+
+# Runs offline against in-memory databases
+
+MIGRATIONS = [
+    ["CREATE TABLE IF NOT EXISTS apartments (id text, name text, size integer)"],
+    [
+        lambda db_connection: rebuild_table(db_connection, "apartments", "id text PRIMARY KEY, name text NOT NULL, size integer", "id, name, size", unique="name"),
+        "CREATE UNIQUE INDEX apartments_name ON apartments (name)",
+    ],
+]
+
+QUERY_PLANS = {"apartment_exists": ("SELECT COUNT(id) FROM apartments WHERE name = ?", (None,))}
+
+
+def legacy_database():
+    db_connection = sqlite3.connect(":memory:", isolation_level=None)
+    db_connection.execute("CREATE TABLE apartments (id text, name text, size integer)")
+    db_connection.executemany("INSERT INTO apartments VALUES (?, ?, ?)", [("1", "a", 10), ("2", "a", 20), ("3", "b", 30), ("3", "c", 40)])
+    return db_connection
+
+
+def test_upgrades_existing_file_in_place():
+    db_connection = legacy_database()
+    changed = migrate(db_connection, MIGRATIONS, QUERY_PLANS)
+
+    assert db_connection.execute("PRAGMA user_version").fetchone()[0] == 2
+    # The first apartment of a name and of an id is kept
+    assert db_connection.execute("SELECT id, name, size FROM apartments ORDER BY id").fetchall() == [("1", "a", 10), ("3", "b", 30)]
+    before, after = changed["apartment_exists"]
+    assert "SCAN apartments" in before
+    assert "USING INDEX apartments_name" in after
+
+
+def test_migrates_once():
+    db_connection = legacy_database()
+    migrate(db_connection, MIGRATIONS, QUERY_PLANS)
+
+    assert migrate(db_connection, MIGRATIONS, QUERY_PLANS) == {}
+    try:
+        db_connection.execute("INSERT INTO apartments VALUES ('4', 'a', 50)")
+        assert False, "names must be unique"
+    except sqlite3.IntegrityError:
+        pass
+
+
+def test_failed_migration_is_rolled_back():
+    db_connection = legacy_database()
+    try:
+        migrate(db_connection, MIGRATIONS + [["CREATE TABLE broken ("]])
+        assert False, "the migration must fail"
+    except sqlite3.Error:
+        pass
+
+    assert db_connection.execute("PRAGMA user_version").fetchone()[0] == 0
+    assert db_connection.execute("SELECT COUNT(*) FROM apartments").fetchone()[0] == 4
@@ -0,0 +1,59 @@
+import os
+import random
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.periods import latest_end, update_max_ends, update_all_max_ends
+
+# Runs offline against in-memory databases
+
+
+def reservations_database():
+    db_connection = sqlite3.connect(":memory:", isolation_level=None)
+    db_connection.execute("CREATE TABLE reservations (id text PRIMARY KEY, apartment text NOT NULL, period_from integer NOT NULL, period_to integer NOT NULL, max_end integer)")
+    db_connection.execute("CREATE INDEX reservations_period ON reservations (apartment, period_from, max_end, period_to)")
+    return db_connection
+
+
+def test_latest_end_matches_every_reservation():
+    rng = random.Random(0)
+    db_connection = reservations_database()
+    reservations = {}
+    for step in range(500):
+        if reservations and rng.random() < 0.3:
+            id = rng.choice(sorted(reservations))
+            apartment, period_from, _ = reservations.pop(id)
+            db_connection.execute("DELETE FROM reservations WHERE id = ?", (id,))
+            update_max_ends(db_connection, apartment, period_from)
+        elif reservations and rng.random() < 0.1:
+            id = rng.choice(sorted(reservations))
+            apartment, previous_from, _ = reservations[id]
+            period_from = rng.randrange(100)
+            reservations[id] = (apartment, period_from, period_from + rng.randrange(1, 20))
+            db_connection.execute("UPDATE reservations SET period_from = ?, period_to = ? WHERE id = ?", (period_from, reservations[id][2], id))
+            update_max_ends(db_connection, apartment, previous_from)
+            update_max_ends(db_connection, apartment, period_from)
+        else:
+            apartment = rng.choice("ab")
+            period_from = rng.randrange(100)
+            reservations[str(step)] = (apartment, period_from, period_from + rng.randrange(1, 20))
+            db_connection.execute("INSERT INTO reservations (id, apartment, period_from, period_to) VALUES (?, ?, ?, ?)", (str(step), *reservations[str(step)]))
+            update_max_ends(db_connection, apartment, period_from)
+
+        for apartment in "ab":
+            before = rng.randrange(120)
+            ends = [period_to for owner, period_from, period_to in reservations.values() if owner == apartment and period_from < before]
+            assert latest_end(db_connection, apartment, before) == (max(ends) if ends else None)
+
+    stored = dict(db_connection.execute("SELECT id, max_end FROM reservations"))
+    db_connection.execute("UPDATE reservations SET max_end = NULL")
+    update_all_max_ends(db_connection)
+    assert dict(db_connection.execute("SELECT id, max_end FROM reservations")) == stored
+
+
+def test_latest_end_is_a_seek():
+    db_connection = reservations_database()
+    plan = "; ".join(row[-1] for row in db_connection.execute("EXPLAIN QUERY PLAN SELECT max_end FROM reservations WHERE apartment = ? AND period_from < ? ORDER BY period_from DESC, max_end DESC LIMIT 1", (None, None)))
+    assert "USING COVERING INDEX reservations_period" in plan
+    assert "TEMP B-TREE" not in plan